@@ -1,26 +1,86 @@
 import sys
 import os
+import json
+import hashlib
+import time
+import multiprocessing
+from multiprocessing import shared_memory
 import numpy as np
 import pandas as pd
 from scipy import stats
 
 import matplotlib.pyplot as plt
 
+try:
+	import numba
+except ImportError:
+	numba = None
+
 # The seed will be fixed to 42 for this assigmnet.
 np.random.seed(42)
 
 NUM_FEATS = 90
 NUM_CLASS = 4
+PREDICT_CHUNK_ROWS = 65536
+MODEL_VERSION = 1
 from sklearn.decomposition import PCA
+from sklearn.feature_selection import mutual_info_classif
 # pca = PCA()
 CLASS_OUTPUT = { "Very Old":0,  "Old":1, "New": 2, "Recent" : 3}
 CLASS_REV_OUTPUT = ["Very Old","Old","New","Recent"]
 
+def param_shapes(num_layers, num_units, output_nn, num_feats=NUM_FEATS):
+	'''
+	Shapes of the (weight, gamma, beta) of every layer of a Net, in the order
+	they are laid out in the flat parameter buffer.
+	'''
+	shapes = []
+	for i in range(num_layers):
+		if i == 0:
+			# Input layer
+			shapes.append(((num_feats, num_units), (num_units, 1), (num_units, 1)))
+		else:
+			# Hidden layer
+			shapes.append(((num_units, num_units), (num_units, 1), (num_units, 1)))
+	# Output layer
+	shapes.append(((num_units, output_nn), (output_nn, 1), (output_nn, 1)))
+	return shapes
+
+def param_count(shapes):
+	return sum(int(np.prod(shape)) for layer in shapes for shape in layer)
+
+def param_segments(shapes):
+	'''
+	(start, end) of every parameter tensor in the flat parameter buffer.
+	'''
+	segments = []
+	offset = 0
+	for layer in shapes:
+		for shape in layer:
+			segments.append((offset, offset + int(np.prod(shape))))
+			offset = segments[-1][1]
+	return segments
+
+def param_views(buffer, shapes):
+	'''
+	Split a flat buffer into lists of weight, gamma and beta views, laid out
+	layer by layer as described by param_shapes().
+	'''
+	views = ([], [], [])
+	offset = 0
+	for layer in shapes:
+		for kind, shape in enumerate(layer):
+			size = int(np.prod(shape))
+			views[kind].append(buffer[offset:offset + size].reshape(shape))
+			offset += size
+	return views
+
+
 class Net(object):
 	'''
 	'''
 
-	def __init__(self, num_layers, num_units, output_nn):
+	def __init__(self, num_layers, num_units, output_nn, momentum=0.1, num_feats=NUM_FEATS):
 		'''
 		Initialize the neural network.
 		Create weights and biases.
@@ -41,14 +101,30 @@ class Net(object):
 		----------
 			num_layers : Number of HIDDEN layers.
 			num_units : Number of units in each Hidden layer.
+			output_nn : Number of units in the output layer.
+			momentum : Weight of the current batch in the moving averages of the
+					   normalization statistics.
+			num_feats : Number of input features (see Preprocessor.num_outputs).
 		'''
 		self.num_layers = num_layers
 		self.num_units = num_units
 		self.output_nn = output_nn
-
-		self.betas = []
-		self.gammas = []
-		self.weights = []
+		self.momentum = momentum
+		self.num_feats = num_feats
+		self.mode = "train"
+		self.pred = None
+		self.d_logits = None
+		self.loss = None
+		self.workspaces = {}
+
+		# All parameters live in one contiguous buffer, and so do their gradients.
+		# weights, gammas and betas (and d_weights, d_gammas, d_betas) are views into them.
+		shapes = param_shapes(num_layers, num_units, output_nn, num_feats)
+		self.params = np.empty(param_count(shapes))
+		self.grads = np.zeros_like(self.params)
+		self.weights, self.gammas, self.betas = param_views(self.params, shapes)
+		self.d_weights, self.d_gammas, self.d_betas = param_views(self.grads, shapes)
+		self.segments = param_segments(shapes)
 		'''
 		for i in range(num_layers):
 
@@ -71,20 +147,45 @@ class Net(object):
 
 			if i==0:
 				# Input layer
-				self.weights.append(np.sqrt(2/NUM_FEATS) * np.random.randn(NUM_FEATS, self.num_units))
+				self.weights[i][...] = np.sqrt(2/self.num_feats) * np.random.randn(self.num_feats, self.num_units)
 			else:
 				# Hidden layer
-				self.weights.append( np.sqrt(2/self.num_units) * np.random.randn(self.num_units, self.num_units))
+				self.weights[i][...] = np.sqrt(2/self.num_units) * np.random.randn(self.num_units, self.num_units)
 
-			self.gammas.append(np.sqrt(2/self.num_units) * np.random.randn(self.num_units, 1))
-			self.betas.append(np.sqrt(2/self.num_units) * np.random.randn(self.num_units, 1))
+			self.gammas[i][...] = np.sqrt(2/self.num_units) * np.random.randn(self.num_units, 1)
+			self.betas[i][...] = np.sqrt(2/self.num_units) * np.random.randn(self.num_units, 1)
 
 		# Output layer
-		self.gammas.append(np.sqrt(2/self.num_units) * np.random.randn(self.output_nn, 1))
-		self.betas.append(np.sqrt(2/self.num_units) * np.random.randn(self.output_nn, 1))
-		self.weights.append(np.sqrt(2/self.num_units) * np.random.randn(self.num_units, self.output_nn))
+		self.gammas[-1][...] = np.sqrt(2/self.num_units) * np.random.randn(self.output_nn, 1)
+		self.betas[-1][...] = np.sqrt(2/self.num_units) * np.random.randn(self.output_nn, 1)
+		self.weights[-1][...] = np.sqrt(2/self.num_units) * np.random.randn(self.num_units, self.output_nn)
+
+		# Moving averages of the per-layer batch mean and std, used in "eval" mode
+		self.running_means = [np.zeros((1, self.num_units)) for i in range(num_layers)]
+		self.running_stds = [np.ones((1, self.num_units)) for i in range(num_layers)]
+
+	def set_mode(self, mode):
+		'''
+		Switch between "train" mode, where hidden layers are normalized with the
+		statistics of the current batch and the moving averages are updated, and
+		"eval" mode, where the moving averages are used instead. In eval mode the
+		output for a row does not depend on the other rows of the batch, so single
+		rows can be scored.
+		'''
+		if mode not in ("train", "eval"):
+			raise ValueError("mode must be 'train' or 'eval', got {}".format(mode))
+		self.mode = mode
 
-	def __call__(self, X):
+	def workspace(self, batch_size):
+		'''
+		Return the Workspace holding the activations and gradients for batches of
+		batch_size rows, creating it on first use.
+		'''
+		if batch_size not in self.workspaces:
+			self.workspaces[batch_size] = Workspace(self, batch_size)
+		return self.workspaces[batch_size]
+
+	def __call__(self, X, y=None):
 		'''
 		Forward propagate the input X through the network,
 		and return the output.
@@ -92,49 +193,168 @@ class Net(object):
 		Note that for a classification task, the output layer should
 		be a softmax layer. So perform the computations accordingly
 
+		When the targets y are given, the cross entropy loss (self.loss) and its
+		gradient w.r.t. the output layer (self.d_logits, used by backward) are
+		computed in the same pass as the softmax.
+
 		Parameters
 		----------
 			X : Input to the network, numpy array of shape m x d
+			y : Class indices of the targets, numpy array of shape m x 1 (optional)
 		Returns
 		----------
-			y : Output of the network, numpy array of shape m x 1
+			y : Class probabilities, numpy array of shape m x NUM_CLASS.
+				This is a buffer owned by the network, overwritten by the next call.
 		'''
+		m = X.shape[0]
+		ws = self.workspace(m)
 		a = X
-		self.h_states = []
-		self.a_states = []
-		self.b_states = []
-		self.std_states = []
 		for i, (w,betas,gammas) in enumerate(zip(self.weights,self.betas, self.gammas)):
-			if i == 0:
-				self.h_states.append(a)  # For input layer, both h and a are same
-			else:
-				self.h_states.append(h)
-			self.a_states.append(a)
-
-			h = np.dot(a, w)
-			# print("h.shape",h.shape)
-			mean_m = np.mean(h,axis=0)
-			# print("mean_m.shape", mean_m.shape)
-			mean_m = mean_m.reshape(1,mean_m.shape[0])
-			std_m = np.std(h, axis=0)
-			std_m = std_m.reshape(1, std_m.shape[0]) + 0.00000001
-
-			b = ((h - mean_m)/std_m)
-
-			self.std_states.append(std_m)
+			h = np.dot(a, w, out=ws.h[i])
 			if i < len(self.weights) - 1:
-				a = relu( (b * gammas.T) + betas.T)
+				# b = (h - mean) / std, computed in the b buffer using the a buffer as scratch
+				b = ws.b[i]
+				if self.mode == "eval":
+					np.copyto(ws.mean[i], self.running_means[i])
+					np.subtract(h, ws.mean[i], out=b)
+					np.add(self.running_stds[i], 0.00000001, out=ws.std[i])
+				else:
+					np.mean(h, axis=0, keepdims=True, out=ws.mean[i])
+					np.subtract(h, ws.mean[i], out=b)
+					np.square(b, out=ws.a[i])
+					np.mean(ws.a[i], axis=0, keepdims=True, out=ws.std[i])
+					np.sqrt(ws.std[i], out=ws.std[i])
+					self.update_running_stats(i, ws.mean[i], ws.std[i])
+					ws.std[i] += 0.00000001
+				b /= ws.std[i]
+
+				a = np.multiply(b, gammas.T, out=ws.a[i])
+				a += betas.T
+				np.maximum(a, 0, out=a)
 			else:  # No activation for the output layer
 				# a =  (b * gammas.T) + betas.T
-				b = h
 				a = h
-			# print("a: ", a)
-			self.b_states.append(b)
-		self.pred = softmax(a)
+		self.pred = ws.pred
+		self.d_logits = ws.d_logits
+		if y is None:
+			softmax(a, out=self.pred)
+			self.loss = None
+		else:
+			self.loss = softmax_cross_entropy(a, y, self.pred, self.d_logits)
 		# print("End")
 		# print("self.pred", self.pred)
 		return self.pred
 
+	def use_buffers(self, params, grads=None, copy=True):
+		'''
+		Move the parameters (and, if given, the gradients) of the network into the
+		flat buffers params and grads, e.g. arrays backed by shared memory. All
+		per-tensor views are rebound to the new buffers.
+
+		Parameters
+		----------
+			copy : copy the current values into the new buffers. Without it the
+				   network takes the values already in params.
+		'''
+		shapes = param_shapes(self.num_layers, self.num_units, self.output_nn, self.num_feats)
+		if copy:
+			np.copyto(params, self.params)
+		self.params = params
+		self.weights, self.gammas, self.betas = param_views(self.params, shapes)
+		if grads is not None:
+			self.grads = grads
+			self.d_weights, self.d_gammas, self.d_betas = param_views(self.grads, shapes)
+
+	def update_running_stats(self, index, mean, std):
+		'''
+		Fold the statistics of the current batch into the moving averages of layer index.
+		'''
+		self.running_means[index] *= 1 - self.momentum
+		self.running_means[index] += self.momentum * mean
+		self.running_stds[index] *= 1 - self.momentum
+		self.running_stds[index] += self.momentum * std
+
+	def recompute_running_stats(self, batches):
+		'''
+		Replace the moving averages by the average batch statistics over one pass of
+		batches, with the weights frozen. While the weights change quickly the moving
+		averages lag behind them; this removes the lag once training is done.
+
+		Parameters
+		----------
+			batches : iterable of (batch_input, batch_target), e.g. a MinibatchShuffler
+		'''
+		means = [np.zeros_like(r) for r in self.running_means]
+		stds = [np.zeros_like(r) for r in self.running_stds]
+		count = 0
+		for batch_input, _ in batches:
+			a = batch_input
+			for i in range(self.num_layers):
+				h = np.dot(a, self.weights[i])
+				mean = h.mean(axis=0, keepdims=True)
+				h -= mean
+				std = h.std(axis=0, keepdims=True)
+				means[i] += mean
+				stds[i] += std
+				h /= std + 0.00000001
+				h *= self.gammas[i].T
+				h += self.betas[i].T
+				a = np.maximum(h, 0, out=h)
+			count += 1
+		for i in range(self.num_layers):
+			np.divide(means[i], count, out=self.running_means[i])
+			np.divide(stds[i], count, out=self.running_stds[i])
+
+	def fold(self, preprocessor=None):
+		'''
+		Export the network for inference, with the normalization of every hidden
+		layer folded into its weights (see FoldedNet). The moving averages of the
+		normalization statistics are used, as in "eval" mode. With a fitted
+		Preprocessor, it is folded into the first layer, so the exported model
+		takes raw feature rows.
+		'''
+		return FoldedNet(self, preprocessor)
+
+	def predict(self, X, chunk_size=PREDICT_CHUNK_ROWS):
+		'''
+		Inference-only forward pass. Unlike __call__, nothing is recorded for
+		backward and the training workspaces are left untouched: X is processed
+		chunk_size rows at a time and only the activation of the current layer of
+		the current chunk is kept, so memory does not grow with the number of rows.
+
+		In "eval" mode the moving averages of the normalization statistics are
+		used, so the output does not depend on chunk_size. In "train" mode each
+		chunk is normalized with its own statistics (and the averages are not updated).
+
+		Parameters
+		----------
+			X : Input to the network, numpy (or memory-mapped) array of shape m x d
+			chunk_size : number of rows forwarded at a time
+		Returns
+		----------
+			y : Class probabilities, numpy array of shape m x NUM_CLASS
+		'''
+		m = X.shape[0]
+		pred = np.empty((m, self.output_nn))
+		for start in range(0, m, chunk_size):
+			end = min(start + chunk_size, m)
+			a = np.asarray(X[start:end], dtype='float64')
+			for i, (w,betas,gammas) in enumerate(zip(self.weights,self.betas, self.gammas)):
+				h = np.dot(a, w)
+				if i < len(self.weights) - 1:
+					if self.mode == "eval":
+						h -= self.running_means[i]
+						h /= self.running_stds[i] + 0.00000001
+					else:
+						h -= h.mean(axis=0, keepdims=True)
+						h /= h.std(axis=0, keepdims=True) + 0.00000001
+					h *= gammas.T
+					h += betas.T
+					np.maximum(h, 0, out=h)
+				a = h
+			softmax(a, out=pred[start:end])
+		return pred
+
 	def backward(self, X, y, lamda):
 		'''
 		Compute and return gradients loss with respect to weights and biases.
@@ -143,7 +363,7 @@ class Net(object):
 		Parameters
 		----------
 			X : Input to the network, numpy array of shape m x d
-			y : Output of the network, numpy array of shape m x 1
+			y : Class indices of the targets, numpy array of shape m x 1
 			lamda : Regularization parameter.
 
 		Returns
@@ -152,45 +372,195 @@ class Net(object):
 			del_b : derivative of loss w.r.t. all bias values (a list of vectors).
 
 		Hint: You need to do a forward pass before performing backward pass.
+		The forward pass must be given the targets, net(X, y), so that the
+		gradient of the loss w.r.t. the output layer is available.
+
+		The returned gradients are views into self.grads, the flat gradient
+		buffer matching self.params, overwritten by the next backward pass.
 		'''
-		d_weights = []
-		d_gammas=[]
-		d_betas=[]
+		ws = self.workspace(X.shape[0])
+		batch_size = y.shape[0]
+		d_h = ws.d_logits
+		d_b = ws.d_logits
+		for index in range(self.num_layers, -1, -1):
+			if index < self.num_layers:
+				np.dot(d_h, self.weights[index + 1].T, out=ws.d_a[index])
+				np.greater(ws.a[index], 0, out=ws.mask[index])
+				d_b = np.multiply(ws.d_a[index], ws.mask[index], out=ws.d_b[index])
+				d_h = np.multiply(d_b, self.gammas[index].T, out=ws.d_h[index])
+				d_h /= ws.std[index]
+				b = ws.b[index]
+			else:
+				b = ws.h[index]  # No normalization for the output layer
+			a = X if index == 0 else ws.a[index - 1]
 
-		d_h_states = []
-		d_a_states = []
-		d_b_states = []
+			d_weights = np.dot(a.T, d_h, out=self.d_weights[index])
+			d_weights *= 1/batch_size
+			if lamda != 0:
+				d_weights += lamda * self.weights[index]
 
-		y_one_hot = reg_to_one_hot(y)
-		# dLossdPred = (self.pred - y)
-		dLossdPred = d_cross_entropy(y_one_hot,self.pred)
-		batch_size = y.shape[0]
-		# print(len(self.a_states))
-		index = self.num_layers
-		#         print(self.pred)
-		for i in range(self.num_layers + 1):
-			if i == 0:
-				d_h_states.insert(0, dLossdPred)
-				d_a_states.insert(0, dLossdPred)
-				d_b_states.insert(0, dLossdPred)
+			# d_b * b goes to the d_a buffer, which is no longer needed
+			np.multiply(d_b, b, out=ws.d_a[index])
+			np.sum(ws.d_a[index], axis=0, out=self.d_gammas[index].reshape(-1))
+			self.d_gammas[index] *= 1/batch_size
 
-			else:
-				d_a_states.insert(0, np.dot(d_h_states[0], self.weights[index + 1].T))
-				d_b_states.insert(0, d_a_states[0] * d_relu(self.a_states[index + 1]))
-				d_h_states.insert(0, d_b_states[0] * (self.gammas[index].T/self.std_states[index]))
-			d_weights.insert(0,  ((1/batch_size) * np.dot(self.a_states[index].T, d_h_states[0])) +   lamda * (self.weights[index] )  )  #+  lamda * self.weights[index]
-			d_gammas.insert(0, ((1/batch_size) * np.sum(d_b_states[0] * self.b_states[index],axis = 0)))
-			d_gammas[0] = d_gammas[0].reshape(d_gammas[0].shape[0], 1)
-
-			d_betas.insert(0, ((1 / batch_size) * np.sum(d_b_states[0], axis=0)))
-			d_betas[0] = d_betas[0].reshape(d_betas[0].shape[0], 1)
-			index = index - 1
-		return d_weights, d_gammas, d_betas
+			np.sum(d_b, axis=0, out=self.d_betas[index].reshape(-1))
+			self.d_betas[index] *= 1/batch_size
+		return self.d_weights, self.d_gammas, self.d_betas
 
 		# loss_gradient = self.a_states[-1] * (self.pred - y)  # batch_size x num_units
 		# update_gradient = 1./batch_size * np.sum(loss_gradient, axis=0) # num_units
 
 
+class FoldedNet(object):
+	'''
+	Inference-only version of a trained Net, made of plain matmul + bias + relu layers.
+
+	A hidden layer of Net computes relu(((a @ w - mean) / std) * gamma + beta) with
+	frozen statistics, which is the same as relu(a @ (w * scale) + (beta - mean * scale))
+	with scale = gamma / std. Folding scale into the weights and the rest into a bias
+	removes three full passes over the activations per layer.
+
+	The affine map of a Preprocessor, X @ matrix + offset, folds into the first
+	layer the same way: (X @ matrix + offset) @ w = X @ (matrix @ w) + offset @ w.
+	'''
+
+	def __init__(self, net, preprocessor=None):
+		'''
+		Parameters
+		----------
+			net : trained Net
+			preprocessor : optional fitted Preprocessor applied to the inputs of net
+		'''
+		self.output_nn = net.output_nn
+		self.weights = []
+		self.biases = []
+		for i, w in enumerate(net.weights):
+			if i < net.num_layers:
+				scale = net.gammas[i].T / (net.running_stds[i] + 0.00000001)
+				self.weights.append(w * scale)
+				self.biases.append(net.betas[i].T - net.running_means[i] * scale)
+			else:  # The output layer is not normalized
+				self.weights.append(w.copy())
+				self.biases.append(np.zeros((1, w.shape[1])))
+		if preprocessor is not None:
+			self.biases[0] = self.biases[0] + np.dot(preprocessor.offset, self.weights[0])
+			self.weights[0] = np.dot(preprocessor.matrix, self.weights[0])
+
+	def predict(self, X, chunk_size=PREDICT_CHUNK_ROWS):
+		'''
+		Forward X through the folded network, chunk_size rows at a time.
+
+		Parameters
+		----------
+			X : Input to the network, numpy (or memory-mapped) array of shape m x d
+			chunk_size : number of rows forwarded at a time
+		Returns
+		----------
+			y : Class probabilities, numpy array of shape m x NUM_CLASS
+		'''
+		m = X.shape[0]
+		pred = np.empty((m, self.output_nn))
+		for start in range(0, m, chunk_size):
+			end = min(start + chunk_size, m)
+			a = np.asarray(X[start:end], dtype='float64')
+			for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+				h = np.dot(a, w)
+				h += b
+				if i < len(self.weights) - 1:
+					np.maximum(h, 0, out=h)
+				a = h
+			softmax(a, out=pred[start:end])
+		return pred
+
+	def save(self, path):
+		'''
+		Save the model for FoldedNet.load: all weights and biases go, one after the
+		other, into a single float64 .npy file at path, and their names, shapes and
+		offsets into the manifest path + ".json".
+		'''
+		arrays = []
+		for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+			arrays.append(("weight_{}".format(i), w))
+			arrays.append(("bias_{}".format(i), b))
+		layout = []
+		offset = 0
+		for name, array in arrays:
+			layout.append([name, list(array.shape), offset])
+			offset += array.size
+
+		tmp_path = path + ".tmp"
+		flat = np.lib.format.open_memmap(tmp_path, mode='w+', dtype='float64', shape=(offset,))
+		for (name, shape, start), (_, array) in zip(layout, arrays):
+			flat[start:start + array.size] = array.reshape(-1)
+		flat.flush()
+		del flat
+		manifest = {"version": MODEL_VERSION, "output_nn": self.output_nn, "arrays": layout}
+		with open(tmp_path + ".json", "w") as f:
+			json.dump(manifest, f)
+		os.replace(tmp_path, path)
+		os.replace(tmp_path + ".json", path + ".json")
+
+	@classmethod
+	def load(cls, path, mmap=True):
+		'''
+		Open a model written by save(). With mmap, the weights and biases are
+		read-only views into the memory-mapped file: loading reads only the
+		manifest, and processes loading the same file share one copy of it
+		through the page cache.
+		'''
+		with open(path + ".json") as f:
+			manifest = json.load(f)
+		if manifest["version"] != MODEL_VERSION:
+			raise ValueError("{} has model version {}, expected {}".format(path, manifest["version"], MODEL_VERSION))
+		flat = np.load(path, mmap_mode='r' if mmap else None)
+
+		model = cls.__new__(cls)
+		model.output_nn = manifest["output_nn"]
+		arrays = {}
+		for name, shape, start in manifest["arrays"]:
+			arrays[name] = flat[start:start + int(np.prod(shape))].reshape(shape)
+		num_layers = len(manifest["arrays"]) // 2
+		model.weights = [arrays["weight_{}".format(i)] for i in range(num_layers)]
+		model.biases = [arrays["bias_{}".format(i)] for i in range(num_layers)]
+		return model
+
+
+class Workspace(object):
+	'''
+	Buffers for the forward activations and the intermediate gradients of a Net,
+	sized once for a batch size and the architecture of the Net. The forward and
+	backward passes write into these buffers (and into Net.grads) through the
+	out= parameters of numpy, so a training step allocates (almost) nothing.
+	'''
+
+	def __init__(self, net, batch_size):
+		'''
+		Parameters
+		----------
+			net : the Net the buffers are for
+			batch_size : number of rows of the batches
+		'''
+		self.batch_size = batch_size
+		units = [w.shape[1] for w in net.weights]
+		hidden = units[:-1]
+
+		# Forward: h = a @ w, b = (h - mean) / std, a = relu(b * gamma + beta)
+		self.h = [np.empty((batch_size, n)) for n in units]
+		self.b = [np.empty((batch_size, n)) for n in hidden]
+		self.a = [np.empty((batch_size, n)) for n in hidden]
+		self.mean = [np.empty((1, n)) for n in hidden]
+		self.std = [np.empty((1, n)) for n in hidden]
+		self.pred = np.empty((batch_size, units[-1]))
+
+		# Backward
+		self.d_logits = np.empty((batch_size, units[-1]))
+		self.d_a = [np.empty((batch_size, n)) for n in units]
+		self.d_b = [np.empty((batch_size, n)) for n in hidden]
+		self.d_h = [np.empty((batch_size, n)) for n in hidden]
+		self.mask = [np.empty((batch_size, n), dtype=bool) for n in hidden]
+
+
 def relu(X):
 	a = np.maximum(X,0)
 	return a
@@ -210,28 +580,71 @@ def d_sigm(X):
 	return X * (1 - X)
 
 
-def softmax(X):
-	# print(X)
-	X_exp_sum = np.sum(np.exp(X),axis = 1).reshape(X.shape[0],1)*np.ones((X.shape[0],X.shape[1]))
-	# print(X_exp_sum)
-	X = np.exp(X)/X_exp_sum
-	# print(X)
-	return X
+def softmax(X, out=None):
+	'''
+	Row-wise softmax. The row max is subtracted before exponentiating so that
+	large inputs cannot overflow.
+	'''
+	out = np.subtract(X, X.max(axis=1, keepdims=True), out=out)
+	np.exp(out, out=out)
+	out /= out.sum(axis=1, keepdims=True)
+	return out
 
-def reg_to_one_hot(X):
-	Y = np.zeros((X.shape[0],NUM_CLASS))
-	X_t = pd.DataFrame(tuple(X.reshape(X.shape[0],)))
-	X_t[X_t == "Very Old"] = 0
-	X_t[X_t == "Old"] = 1
-	X_t[X_t == "New"] = 2
-	X_t[X_t == "Recent"] = 3
-	X_t = X_t.to_numpy().reshape(X.shape[0],)
-	Y[np.arange(X.shape[0]), X_t.astype(int)] = 1
-	return Y
+def softmax_cross_entropy(logits, y, prob, grad=None):
+	'''
+	Fused softmax and cross entropy loss.
 
+	The loss is taken from the log-softmax, log(sum(exp(z - max))) - (z_y - max),
+	instead of the log of the probabilities, so it stays finite for large logits.
 
-def d_cross_entropy(y,y_hat):
-	return y_hat - y
+	Parameters
+	----------
+		logits : output layer activations, numpy array of shape m x NUM_CLASS
+		y : class indices of the targets, numpy array of shape m x 1
+		prob : buffer of shape m x NUM_CLASS receiving softmax(logits)
+		grad : buffer of shape m x NUM_CLASS receiving dL/dlogits = prob - one_hot(y) (optional)
+
+	Returns
+	----------
+		cross entropy loss, in bits like cross_entropy_loss
+	'''
+	m = logits.shape[0]
+	rows = np.arange(m)
+	y = y.reshape(m)
+
+	np.subtract(logits, logits.max(axis=1, keepdims=True), out=prob)
+	shifted_y = prob[rows, y]
+	np.exp(prob, out=prob)
+	norm = prob.sum(axis=1, keepdims=True)
+	prob /= norm
+	loss = np.sum(np.log(norm.reshape(m)) - shifted_y) / (m * np.log(2))
+
+	if grad is not None:
+		np.copyto(grad, prob)
+		grad[rows, y] -= 1
+	return loss
+
+def encode_labels(Y):
+	'''
+	Map class names to their integer class index in CLASS_OUTPUT.
+
+	Parameters
+	----------
+		Y : class names, numpy array of shape m x 1 (or m)
+
+	Returns
+	----------
+		class indices, int8 numpy array of shape m x 1
+	'''
+	classes, inverse = np.unique(np.asarray(Y).reshape(-1), return_inverse=True)
+	codes = np.array([CLASS_OUTPUT[c] for c in classes], dtype='int8')
+	return codes[inverse].reshape(-1, 1)
+
+def decode_labels(Y):
+	'''
+	Map integer class indices back to class names.
+	'''
+	return np.asarray(CLASS_REV_OUTPUT)[np.asarray(Y).reshape(-1)].reshape(-1, 1)
 
 def cross_entropy_loss(y, y_hat):
 	'''
@@ -239,163 +652,878 @@ def cross_entropy_loss(y, y_hat):
 
 	Parameters
 	----------
-		y : targets, numpy array of shape m x 1
-		y_hat : predictions, numpy array of shape m x 1
+		y : class indices of the targets, numpy array of shape m x 1
+		y_hat : predicted class probabilities, numpy array of shape m x NUM_CLASS
 
 	Returns
 	----------
 		cross entropy loss
 	'''
-	y_index = y.argmax(axis=1)
+	y_index = y.reshape(y.shape[0])
 	# print("y_index: ", y_index)
 	y_hat_t = y_hat[np.arange(y.shape[0]),y_index]
 	# print(y_hat_t)
-	loss = np.sum(-( np.log2(y_hat_t)))/y_hat.shape[0]
+	loss = np.sum(-( np.log2(np.maximum(y_hat_t, np.finfo(y_hat.dtype).tiny))))/y_hat.shape[0]
 	return loss
 
 def one_hot_to_reg(Y):
-	Y = Y.argmax(axis = 1)
-	X = pd.DataFrame(Y)
-	X[X== 0] = "Very Old"
-	X[X == 1] = "Old"
-	X[X == 2] = "New"
-	X[X == 3] = "Recent"
-
-	a = X.to_numpy().reshape(Y.shape[0],1)
-	return a
+	return decode_labels(Y.argmax(axis = 1))
+
+OPTIMIZERS = {}
+
+def register_optimizer(name):
+	'''
+	Class decorator adding an Optimizer subclass to OPTIMIZERS under name.
+	'''
+	def register(cls):
+		cls.name = name
+		OPTIMIZERS[name] = cls
+		return cls
+	return register
+
+def make_optimizer(optimizer_type, learning_rate, **kwargs):
+	'''
+	Create the optimizer registered under optimizer_type, e.g.
+	make_optimizer("ADAM", 0.002, beta1=0.9, beta2=0.999).
+	'''
+	if optimizer_type not in OPTIMIZERS:
+		raise ValueError("unknown optimizer {}, expected one of {}".format(optimizer_type, sorted(OPTIMIZERS)))
+	return OPTIMIZERS[optimizer_type](learning_rate, **kwargs)
+
+def scale_learning_rate(learning_rate, batch_size, base_batch_size=64, scaling="linear"):
+	'''
+	Scale a learning rate tuned for base_batch_size to batch_size.
+
+	Parameters
+	----------
+		scaling : "linear" (proportional to the batch size, for SGD and momentum)
+				  or "sqrt" (proportional to its square root, for the adaptive optimizers)
+	'''
+	if scaling == "linear":
+		return learning_rate * batch_size / base_batch_size
+	if scaling == "sqrt":
+		return learning_rate * np.sqrt(batch_size / base_batch_size)
+	raise ValueError("scaling must be 'linear' or 'sqrt', got {!r}".format(scaling))
+
+def large_batch_optimizer(
+	optimizer_type, learning_rate, batch_size, num_rows,
+	base_batch_size=64, scaling="sqrt", warmup_epochs=5, **kwargs
+):
+	'''
+	Optimizer for training with batch_size rows per batch, given hyper-parameters
+	tuned at base_batch_size: the learning rate is scaled to the batch size and
+	warmed up over the first warmup_epochs epochs of num_rows rows. Pair with
+	"LARS" or "LAMB" to also apply layer-wise trust ratios.
+	'''
+	steps_per_epoch = max(1, int(np.ceil(num_rows / batch_size)))
+	return make_optimizer(
+		optimizer_type,
+		scale_learning_rate(learning_rate, batch_size, base_batch_size, scaling),
+		warmup_steps=warmup_epochs * steps_per_epoch,
+		**kwargs
+	)
 
 class Optimizer(object):
 	'''
+	Base class of the optimizers in OPTIMIZERS.
+
+	The state of an optimizer (its moments, in self.state) is allocated lazily
+	from the shape of the parameters on the first step, so an optimizer does not
+	need to know the architecture of the network. Subclasses implement update().
 	'''
 
-	def __init__(self, learning_rate, optimizer_type):
+	supports_numba = False
+
+	def __init__(self, learning_rate, use_numba=False, warmup_steps=0):
 		'''
 		Create a Gradient Descent based optimizer with given
 		learning rate.
 
-		Other parameters can also be passed to create different types of
-		optimizers.
-
-		Hint: You can use the class members to track various states of the
-		optimizer.
+		Parameters
+		----------
+			learning_rate : step size
+			use_numba : run the updates as single-pass numba kernels (needs numba)
+			warmup_steps : ramp the step size linearly from learning_rate / warmup_steps
+						   up to learning_rate over the first warmup_steps steps
 		'''
+		if use_numba and numba is None:
+			raise ImportError("use_numba=True needs the numba package")
+		if use_numba and not self.supports_numba:
+			raise ValueError("{} has no numba kernel".format(self.name))
 		self.learning_rate = learning_rate
-		self.optimizer_type = optimizer_type
+		self.lr = learning_rate
+		self.use_numba = use_numba
+		self.warmup_steps = warmup_steps
+		self.t = 0
+		self.state = None
+		self.scratch = None
+
+	def init_state(self, params):
+		'''
+		Return the dict of state buffers for parameters shaped like params.
+		'''
+		return {}
+
+	def step(self, params, grads, segments=None):
+		'''
+		Update all parameters in place. The state is updated in place as well,
+		and intermediate results go to one preallocated scratch buffer, so SGD,
+		momentum, RMSProp and Adam steps allocate no temporary arrays.
+
+		Parameters
+		----------
+			params: Flat parameter buffer of the network (Net.params).
+			grads: Gradients of the loss with respect to params (Net.grads).
+			segments: (start, end) of every parameter tensor in params (Net.segments),
+					  used by the layer-wise optimizers. Defaults to the whole buffer.
+		'''
+		if self.state is None:
+			self.state = self.init_state(params)
+		if self.scratch is None or self.scratch.shape != params.shape:
+			self.scratch = np.empty_like(params)
+		if segments is None:
+			segments = [(0, params.shape[0])]
+		self.t += 1
+		self.lr = self.learning_rate
+		if self.t < self.warmup_steps:
+			self.lr = self.learning_rate * self.t / self.warmup_steps
+		self.update(params, grads, self.scratch, segments)
+
+	def update(self, params, grads, scratch, segments):
+		'''
+		Apply one step of size self.lr to params.
+		'''
+		raise NotImplementedError
+
+	def state_dict(self):
+		'''
+		Everything needed to resume the optimizer, for checkpoints: its name, its
+		constructor arguments (config), the step count and the state arrays.
+		'''
+		config = {
+			k: v for k, v in self.__dict__.items()
+			if isinstance(v, (bool, int, float)) and k not in ("t", "lr")
+		}
+		return {"name": self.name, "config": config, "t": self.t, "state": dict(self.state or {})}
 
-	def SGD_MR(self, beta, num_layers, num_units, output_nn):
+	def load_state_dict(self, state):
+		self.learning_rate = state["config"]["learning_rate"]
+		self.t = state["t"]
+		self.state = {k: np.array(v) for k, v in state["state"].items()} or None
+
+
+@register_optimizer("SGD")
+class SGD(Optimizer):
+	'''
+	Plain gradient descent.
+	'''
+
+	supports_numba = True
+
+	def update(self, params, grads, scratch, segments):
+		if self.use_numba:
+			_sgd_kernel(params, grads, self.lr)
+			return
+		np.multiply(grads, self.lr, out=scratch)
+		params -= scratch
+
+
+@register_optimizer("SGDMomentum")
+class SGDMomentum(Optimizer):
+	'''
+	Gradient descent on an exponential moving average of the gradients.
+	'''
+
+	supports_numba = True
+
+	def __init__(self, learning_rate, beta=0.9, **kwargs):
+		Optimizer.__init__(self, learning_rate, **kwargs)
 		self.beta = beta
-		self.Vt = []
-		self.Bt = []
-		self.Gt = []
-		for i in range(num_layers):
 
-			if i==0:
-				# Input layer
-				self.Vt.append(np.zeros(((NUM_FEATS, num_units))))
-			else:
-				# Hidden layer
-				self.Vt.append(np.zeros((num_units, num_units)))
+	def init_state(self, params):
+		return {"Vt": np.zeros_like(params)}
 
-			self.Bt.append(np.zeros((num_units, 1)))
-			self.Gt.append(np.zeros((num_units, 1)))
+	def update(self, params, grads, scratch, segments):
+		Vt = self.state["Vt"]
+		if self.use_numba:
+			_momentum_kernel(params, grads, Vt, self.lr, self.beta)
+			return
+		Vt *= self.beta
+		np.multiply(grads, 1 - self.beta, out=scratch)
+		Vt += scratch
+		np.multiply(Vt, self.lr, out=scratch)
+		params -= scratch
 
-		# Output layer
-		self.Bt.append(np.zeros((output_nn, 1)))
-		self.Gt.append(np.zeros((output_nn, 1)))
-		self.Vt.append(np.zeros((num_units, output_nn)))
 
-	def SGD_ADAM(self, beta1,beta2, num_layers, num_units, output_nn):
+@register_optimizer("Nesterov")
+class Nesterov(SGDMomentum):
+	'''
+	Momentum with Nesterov's look-ahead: the step uses the moving average
+	updated once more with the current gradient.
+	'''
+
+	supports_numba = False
+
+	def update(self, params, grads, scratch, segments):
+		Vt = self.state["Vt"]
+		Vt *= self.beta
+		np.multiply(grads, 1 - self.beta, out=scratch)
+		Vt += scratch
+		# params -= lr * (beta * Vt + (1 - beta) * grads)
+		np.multiply(Vt, self.lr * self.beta, out=scratch)
+		params -= scratch
+		np.multiply(grads, self.lr * (1 - self.beta), out=scratch)
+		params -= scratch
+
+
+@register_optimizer("LARS")
+class LARS(SGDMomentum):
+	'''
+	Layer-wise adaptive rate scaling: momentum SGD where the gradient (plus
+	weight decay) of every parameter tensor is rescaled by the trust ratio
+	eta * ||params|| / ||gradient|| of that tensor.
+	'''
+
+	supports_numba = False
+
+	def __init__(self, learning_rate, beta=0.9, weight_decay=0.0, eta=0.001, **kwargs):
+		SGDMomentum.__init__(self, learning_rate, beta=beta, **kwargs)
+		self.weight_decay = weight_decay
+		self.eta = eta
+
+	def update(self, params, grads, scratch, segments):
+		Vt = self.state["Vt"]
+		np.copyto(scratch, grads)
+		if self.weight_decay != 0:
+			scratch += self.weight_decay * params
+		for start, end in segments:
+			param_norm = np.linalg.norm(params[start:end])
+			grad_norm = np.linalg.norm(scratch[start:end])
+			ratio = self.eta * param_norm / grad_norm if param_norm > 0 and grad_norm > 0 else 1.0
+			scratch[start:end] *= ratio * (1 - self.beta)
+		Vt *= self.beta
+		Vt += scratch
+		np.multiply(Vt, self.lr, out=scratch)
+		params -= scratch
+
+
+@register_optimizer("RMSProp")
+class RMSProp(Optimizer):
+	'''
+	Gradient descent scaled by a moving average of the squared gradients.
+	'''
+
+	supports_numba = True
+
+	def __init__(self, learning_rate, beta=0.999, eps=0.00000001, **kwargs):
+		Optimizer.__init__(self, learning_rate, **kwargs)
+		self.beta = beta
+		self.eps = eps
+
+	def init_state(self, params):
+		return {"Vt": np.zeros_like(params)}
+
+	def update(self, params, grads, scratch, segments):
+		Vt = self.state["Vt"]
+		if self.use_numba:
+			_rmsprop_kernel(params, grads, Vt, self.lr, self.beta, self.eps)
+			return
+		Vt *= self.beta
+		np.square(grads, out=scratch)
+		scratch *= 1 - self.beta
+		Vt += scratch
+		np.add(Vt, self.eps, out=scratch)
+		np.sqrt(scratch, out=scratch)
+		np.divide(grads, scratch, out=scratch)
+		scratch *= self.lr
+		params -= scratch
+
+
+@register_optimizer("Adagrad")
+class Adagrad(Optimizer):
+	'''
+	Gradient descent scaled by the sum of all past squared gradients.
+	'''
+
+	def __init__(self, learning_rate, eps=0.00000001, **kwargs):
+		Optimizer.__init__(self, learning_rate, **kwargs)
+		self.eps = eps
+
+	def init_state(self, params):
+		return {"Gt": np.zeros_like(params)}
+
+	def update(self, params, grads, scratch, segments):
+		Gt = self.state["Gt"]
+		np.square(grads, out=scratch)
+		Gt += scratch
+		np.add(Gt, self.eps, out=scratch)
+		np.sqrt(scratch, out=scratch)
+		np.divide(grads, scratch, out=scratch)
+		scratch *= self.lr
+		params -= scratch
+
+
+@register_optimizer("ADAM")
+class ADAM(Optimizer):
+	'''
+	Adam, with bias correction of the moments (which start at zero).
+	'''
+
+	supports_numba = True
+
+	def __init__(self, learning_rate, beta1=0.9, beta2=0.999, eps=0.000001, **kwargs):
+		Optimizer.__init__(self, learning_rate, **kwargs)
 		self.beta1 = beta1
 		self.beta2 = beta2
-		self.Vt = []
-		self.Vt2=[]
-		self.Bt = []
-		self.Bt2 = []
-		self.Gt = []
-		self.Gt2 = []
-		for i in range(num_layers):
+		self.eps = eps
 
-			if i==0:
-				# Input layer
-				self.Vt.append(np.zeros(((NUM_FEATS, num_units))))
-				self.Vt2.append(np.zeros(((NUM_FEATS, num_units))))
+	def init_state(self, params):
+		return {"Vt": np.zeros_like(params), "Vt2": np.zeros_like(params)}
 
-			else:
-				# Hidden layer
-				self.Vt.append(np.zeros((num_units, num_units)))
-				self.Vt2.append(np.zeros((num_units, num_units)))
+	def adam_direction(self, grads, scratch):
+		'''
+		Update the moments and write the bias-corrected Adam direction
+		(Vt / correction1) / sqrt(Vt2 / correction2 + eps) to scratch.
+		'''
+		Vt = self.state["Vt"]
+		Vt2 = self.state["Vt2"]
+		correction1 = 1 - self.beta1 ** self.t
+		correction2 = 1 - self.beta2 ** self.t
+
+		Vt *= self.beta1
+		np.multiply(grads, 1 - self.beta1, out=scratch)
+		Vt += scratch
+		Vt2 *= self.beta2
+		np.square(grads, out=scratch)
+		scratch *= 1 - self.beta2
+		Vt2 += scratch
+
+		np.multiply(Vt2, 1 / correction2, out=scratch)
+		scratch += self.eps
+		np.sqrt(scratch, out=scratch)
+		np.divide(Vt, scratch, out=scratch)
+		scratch *= 1 / correction1
+
+	def update(self, params, grads, scratch, segments):
+		if self.use_numba:
+			_adam_kernel(params, grads, self.state["Vt"], self.state["Vt2"], self.lr, self.beta1, self.beta2,
+						 1 - self.beta1 ** self.t, 1 - self.beta2 ** self.t, self.eps)
+			return
+		self.adam_direction(grads, scratch)
+		scratch *= self.lr
+		params -= scratch
+
+
+@register_optimizer("AdamW")
+class AdamW(ADAM):
+	'''
+	Adam with decoupled weight decay: the parameters are shrunk directly
+	instead of adding the decay to the gradients.
+	'''
 
-			self.Bt.append(np.zeros((num_units, 1)))
-			self.Bt2.append(np.zeros((num_units, 1)))
+	supports_numba = False
 
-			self.Gt.append(np.zeros((num_units, 1)))
-			self.Gt2.append(np.zeros((num_units, 1)))
+	def __init__(self, learning_rate, weight_decay=0.01, **kwargs):
+		ADAM.__init__(self, learning_rate, **kwargs)
+		self.weight_decay = weight_decay
 
-		# Output layer
-		self.Bt.append(np.zeros((output_nn, 1)))
-		self.Bt2.append(np.zeros((output_nn, 1)))
+	def update(self, params, grads, scratch, segments):
+		params *= 1 - self.lr * self.weight_decay
+		ADAM.update(self, params, grads, scratch, segments)
+
+
+@register_optimizer("LAMB")
+class LAMB(ADAM):
+	'''
+	Layer-wise adaptive Adam: the Adam direction (plus weight decay) of every
+	parameter tensor is rescaled by the trust ratio ||params|| / ||direction||
+	of that tensor, which keeps large-batch training stable.
+	'''
+
+	supports_numba = False
 
-		self.Gt.append(np.zeros((output_nn, 1)))
-		self.Gt2.append(np.zeros((output_nn, 1)))
+	def __init__(self, learning_rate, weight_decay=0.0, **kwargs):
+		ADAM.__init__(self, learning_rate, **kwargs)
+		self.weight_decay = weight_decay
 
-		self.Vt.append(np.zeros((num_units, output_nn)))
-		self.Vt2.append(np.zeros((num_units, output_nn)))
+	def update(self, params, grads, scratch, segments):
+		self.adam_direction(grads, scratch)
+		if self.weight_decay != 0:
+			scratch += self.weight_decay * params
+		for start, end in segments:
+			param_norm = np.linalg.norm(params[start:end])
+			update_norm = np.linalg.norm(scratch[start:end])
+			ratio = param_norm / update_norm if param_norm > 0 and update_norm > 0 else 1.0
+			scratch[start:end] *= self.lr * ratio
+		params -= scratch
 
 
+@register_optimizer("Lion")
+class Lion(Optimizer):
+	'''
+	Lion: steps of constant size along the sign of an interpolation between the
+	moving average of the gradients and the current gradient.
+	'''
+
+	def __init__(self, learning_rate, beta1=0.9, beta2=0.99, weight_decay=0.0, **kwargs):
+		Optimizer.__init__(self, learning_rate, **kwargs)
+		self.beta1 = beta1
+		self.beta2 = beta2
+		self.weight_decay = weight_decay
+
+	def init_state(self, params):
+		return {"Vt": np.zeros_like(params)}
+
+	def update(self, params, grads, scratch, segments):
+		Vt = self.state["Vt"]
+		np.multiply(Vt, self.beta1, out=scratch)
+		scratch += (1 - self.beta1) * grads
+		np.sign(scratch, out=scratch)
+		if self.weight_decay != 0:
+			scratch += self.weight_decay * params
+		scratch *= self.lr
+		params -= scratch
+
+		Vt *= self.beta2
+		np.multiply(grads, 1 - self.beta2, out=scratch)
+		Vt += scratch
+
+
+if numba is not None:
+	@numba.njit(cache=True)
+	def _sgd_kernel(params, grads, lr):
+		for i in range(params.shape[0]):
+			params[i] -= lr * grads[i]
+
+	@numba.njit(cache=True)
+	def _momentum_kernel(params, grads, v, lr, beta):
+		for i in range(params.shape[0]):
+			v[i] = beta * v[i] + (1 - beta) * grads[i]
+			params[i] -= lr * v[i]
+
+	@numba.njit(cache=True)
+	def _rmsprop_kernel(params, grads, v, lr, beta, eps):
+		for i in range(params.shape[0]):
+			v[i] = beta * v[i] + (1 - beta) * grads[i] * grads[i]
+			params[i] -= lr / np.sqrt(v[i] + eps) * grads[i]
+
+	@numba.njit(cache=True)
+	def _adam_kernel(params, grads, v, v2, lr, beta1, beta2, correction1, correction2, eps):
+		for i in range(params.shape[0]):
+			v[i] = beta1 * v[i] + (1 - beta1) * grads[i]
+			v2[i] = beta2 * v2[i] + (1 - beta2) * grads[i] * grads[i]
+			params[i] -= lr * (v[i] / correction1) / np.sqrt(v2[i] / correction2 + eps)
+
+SCHEDULERS = {}
+
+def register_scheduler(name):
+	'''
+	Class decorator adding an LRScheduler subclass to SCHEDULERS under name.
+	'''
+	def register(cls):
+		cls.name = name
+		SCHEDULERS[name] = cls
+		return cls
+	return register
+
+def make_scheduler(scheduler_type, optimizer, **kwargs):
+	'''
+	Create the learning rate scheduler registered under scheduler_type for
+	optimizer, e.g. make_scheduler("cosine", optimizer, total_steps=50).
+	'''
+	if scheduler_type not in SCHEDULERS:
+		raise ValueError("unknown scheduler {}, expected one of {}".format(scheduler_type, sorted(SCHEDULERS)))
+	return SCHEDULERS[scheduler_type](optimizer, **kwargs)
+
+class LRScheduler(object):
+	'''
+	Base class of the learning rate schedulers in SCHEDULERS.
+
+	A scheduler sets optimizer.learning_rate each time step() is called; train()
+	calls it after every batch if interval is "step" and after every epoch if
+	it is "epoch", passing the dev loss when needs_metric is set. Subclasses
+	implement get_lr() from self.base_lr and self.last_step.
+	'''
+
+	interval = "epoch"
+	needs_metric = False
 
-	def step(self, weights, gammas, betas, delta_weights, delta_gammas, delta_betas):
+	def __init__(self, optimizer):
+		self.optimizer = optimizer
+		self.base_lr = optimizer.learning_rate
+		self.last_step = 0
+
+	def step(self, metric=None):
+		self.last_step += 1
+		self.optimizer.learning_rate = self.get_lr(metric)
+
+	def get_lr(self, metric):
+		raise NotImplementedError
+
+	def state_dict(self):
+		'''
+		Everything needed to resume the schedule, for checkpoints.
+		'''
+		state = {k: v for k, v in self.__dict__.items() if k != "optimizer"}
+		state["learning_rate"] = self.optimizer.learning_rate
+		return state
+
+	def load_state_dict(self, state):
+		state = dict(state)
+		self.optimizer.learning_rate = state.pop("learning_rate")
+		self.__dict__.update(state)
+
+
+@register_scheduler("step")
+class StepLR(LRScheduler):
+	'''
+	Multiply the learning rate by gamma every step_size epochs.
+	'''
+
+	def __init__(self, optimizer, step_size, gamma=0.1):
+		LRScheduler.__init__(self, optimizer)
+		self.step_size = step_size
+		self.gamma = gamma
+
+	def get_lr(self, metric):
+		return self.base_lr * self.gamma ** (self.last_step // self.step_size)
+
+
+@register_scheduler("cosine")
+class CosineLR(LRScheduler):
+	'''
+	Anneal the learning rate from its initial value to min_lr along half a
+	cosine over total_steps epochs (or batches, with interval="step").
+	'''
+
+	def __init__(self, optimizer, total_steps, min_lr=0.0, interval="epoch"):
+		LRScheduler.__init__(self, optimizer)
+		self.total_steps = total_steps
+		self.min_lr = min_lr
+		self.interval = interval
+
+	def get_lr(self, metric):
+		progress = min(self.last_step, self.total_steps) / self.total_steps
+		return float(self.min_lr + (self.base_lr - self.min_lr) * (1 + np.cos(np.pi * progress)) / 2)
+
+
+@register_scheduler("one_cycle")
+class OneCycleLR(LRScheduler):
+	'''
+	One-cycle policy, stepped per batch: the learning rate rises from
+	max_lr / div_factor to max_lr over the first pct_start of total_steps and
+	then anneals to max_lr / (div_factor * final_div_factor).
+	'''
+
+	interval = "step"
+
+	def __init__(self, optimizer, max_lr, total_steps, pct_start=0.3, div_factor=25.0, final_div_factor=10000.0):
+		LRScheduler.__init__(self, optimizer)
+		self.max_lr = max_lr
+		self.total_steps = total_steps
+		self.pct_start = pct_start
+		self.initial_lr = max_lr / div_factor
+		self.final_lr = self.initial_lr / final_div_factor
+		optimizer.learning_rate = self.initial_lr
+
+	def get_lr(self, metric):
+		warmup_steps = max(1, int(self.pct_start * self.total_steps))
+		if self.last_step <= warmup_steps:
+			start, end, progress = self.initial_lr, self.max_lr, self.last_step / warmup_steps
+		else:
+			start, end = self.max_lr, self.final_lr
+			progress = min(1.0, (self.last_step - warmup_steps) / max(1, self.total_steps - warmup_steps))
+		return float(end + (start - end) * (1 + np.cos(np.pi * progress)) / 2)
+
+
+@register_scheduler("plateau")
+class ReduceLROnPlateau(LRScheduler):
+	'''
+	Multiply the learning rate by factor when the dev loss has not improved by
+	more than threshold (relative) for patience epochs.
+	'''
+
+	needs_metric = True
+
+	def __init__(self, optimizer, factor=0.1, patience=10, threshold=0.0001, min_lr=0.0):
+		LRScheduler.__init__(self, optimizer)
+		self.factor = factor
+		self.patience = patience
+		self.threshold = threshold
+		self.min_lr = min_lr
+		self.best = np.inf
+		self.bad_epochs = 0
+
+	def get_lr(self, metric):
+		if metric is None:
+			raise ValueError("ReduceLROnPlateau.step() needs the dev loss")
+		lr = self.optimizer.learning_rate
+		if metric < self.best * (1 - self.threshold):
+			self.best = float(metric)
+			self.bad_epochs = 0
+		else:
+			self.bad_epochs += 1
+			if self.bad_epochs > self.patience:
+				lr = max(self.min_lr, lr * self.factor)
+				self.bad_epochs = 0
+		return lr
+
+class EarlyStopping(object):
+	'''
+	Stop training once the dev metric has not improved for patience
+	evaluations, and restore the parameters of the best evaluation.
+
+	The best parameters are kept as a copy of the flat parameter buffer (and
+	the running normalization statistics) in arrays allocated once, so taking
+	a snapshot is a single memcpy.
+	'''
+
+	def __init__(self, patience=10, min_delta=0.0, every=1, metric="loss"):
 		'''
 		Parameters
 		----------
-			weights: Current weights of the network.
-			biases: Current biases of the network.
-			delta_weights: Gradients of weights with respect to loss.
-			delta_biases: Gradients of biases with respect to loss.
-		'''
-
-		if self.optimizer_type == "SGD":
-			for index in range(len(weights)):
-				weights[index] = weights[index] - self.learning_rate * delta_weights[index]
-				gammas[index] = gammas[index] - self.learning_rate * delta_gammas[index]
-				betas[index] = betas[index] - self.learning_rate * delta_betas[index]
-
-		elif self.optimizer_type == "SGDMomentum":
-			for index in range(len(weights)):
-				self.Vt[index] = self.beta * self.Vt[index] + (1 - self.beta) * delta_weights[index]
-				self.Bt[index] = self.beta * self.Bt[index] + (1 - self.beta) * delta_betas[index]
-				self.Gt[index] = self.beta * self.Gt[index] + (1 - self.beta) * delta_gammas[index]
-				weights[index] = weights[index] - self.learning_rate * self.Vt[index]
-				betas[index] = betas[index] - self.learning_rate * self.Bt[index]
-				gammas[index] = gammas[index] - self.learning_rate * self.Gt[index]
-
-		elif self.optimizer_type == "RMSProp":
-			for index in range(len(weights)):
-				self.Vt[index] = self.beta * self.Vt[index] + (1 - self.beta) * np.square(delta_weights[index])
-				self.Bt[index] = self.beta * self.Bt[index] + (1 - self.beta) * np.square(delta_betas[index])
-				self.Gt[index] = self.beta * self.Gt[index] + (1 - self.beta) * np.square(delta_gammas[index])
-				weights[index] = weights[index] - (self.learning_rate / (np.sqrt(self.Vt[index] + 0.00000001))) * (delta_weights[index] )
-				betas[index] = betas[index] - (self.learning_rate / (np.sqrt(self.Bt[index] + 0.00000001))) * (delta_betas[index])
-				gammas[index] = gammas[index] - (self.learning_rate / (np.sqrt(self.Gt[index] + 0.00000001))) * (delta_gammas[index])
-			# print(self.Vt)
-			# print(self.Bt)
-
-		elif self.optimizer_type == "ADAM":
-			for index in range(len(weights)):
-				self.Vt[index] = self.beta1 * self.Vt[index] + (1 - self.beta1) * delta_weights[index]
-				self.Bt[index] = self.beta1 * self.Bt[index] + (1 - self.beta1) * delta_betas[index]
-				self.Gt[index] = self.beta1 * self.Gt[index] + (1 - self.beta1) * delta_gammas[index]
-
-				self.Vt2[index] = self.beta2 * self.Vt2[index] + (1 - self.beta2) * np.square(delta_weights[index])
-				self.Bt2[index] = self.beta2 * self.Bt2[index] + (1 - self.beta2) * np.square(delta_betas[index])
-				self.Gt2[index] = self.beta2 * self.Gt2[index] + (1 - self.beta2) * np.square(delta_gammas[index])
-
-
-				weights[index] = weights[index] - self.learning_rate * (self.Vt[index] / (np.sqrt(self.Vt2[index] + 0.000001)))
-				betas[index] = betas[index] - self.learning_rate * (self.Bt[index]/(np.sqrt(self.Bt2[index] + 0.000001)))
-				gammas[index] = gammas[index] - self.learning_rate * (self.Gt[index]/(np.sqrt(self.Gt2[index] + 0.000001)))
-
-
-		return weights, gammas,betas
+			patience : number of evaluations without improvement before stopping
+			min_delta : smallest change of the metric counted as an improvement
+			every : evaluate the dev data every this many epochs
+			metric : "loss" (dev cross entropy, lower is better) or "accuracy"
+		'''
+		if metric not in ("loss", "accuracy"):
+			raise ValueError("metric must be 'loss' or 'accuracy', got {!r}".format(metric))
+		self.patience = patience
+		self.min_delta = min_delta
+		self.every = every
+		self.metric = metric
+		self.best = np.inf
+		self.best_epoch = None
+		self.bad_evaluations = 0
+		self.best_params = None
+		self.best_running_means = None
+		self.best_running_stds = None
+
+	def should_evaluate(self, epoch):
+		return (epoch + 1) % self.every == 0
+
+	def snapshot(self, net):
+		if self.best_params is None:
+			self.best_params = np.empty_like(net.params)
+			self.best_running_means = [np.empty_like(mean) for mean in net.running_means]
+			self.best_running_stds = [np.empty_like(std) for std in net.running_stds]
+		np.copyto(self.best_params, net.params)
+		for src, dst in zip(net.running_means, self.best_running_means):
+			np.copyto(dst, src)
+		for src, dst in zip(net.running_stds, self.best_running_stds):
+			np.copyto(dst, src)
+
+	def restore(self, net):
+		'''
+		Copy the best parameters seen back into net.
+		'''
+		if self.best_params is None:
+			return
+		np.copyto(net.params, self.best_params)
+		for src, dst in zip(self.best_running_means, net.running_means):
+			np.copyto(dst, src)
+		for src, dst in zip(self.best_running_stds, net.running_stds):
+			np.copyto(dst, src)
+
+	def update(self, net, epoch, dev_loss, dev_accuracy):
+		'''
+		Record the dev metrics of epoch, snapshot net if they are the best so
+		far, and return True once training should stop.
+		'''
+		# Lower is better for both, so accuracy is tracked negated
+		value = dev_loss if self.metric == "loss" else -dev_accuracy
+		if value < self.best - self.min_delta:
+			self.best = value
+			self.best_epoch = epoch
+			self.bad_evaluations = 0
+			self.snapshot(net)
+		else:
+			self.bad_evaluations += 1
+		return self.bad_evaluations >= self.patience
+
+	def state_dict(self):
+		'''
+		The progress so far, as a JSON-serializable config and a dict of the
+		snapshot arrays (empty before the first evaluation).
+		'''
+		config = {"best": float(self.best), "best_epoch": self.best_epoch, "bad_evaluations": self.bad_evaluations}
+		arrays = {}
+		if self.best_params is not None:
+			arrays["params"] = self.best_params
+			for i in range(len(self.best_running_means)):
+				arrays["running_mean_{}".format(i)] = self.best_running_means[i]
+				arrays["running_std_{}".format(i)] = self.best_running_stds[i]
+		return config, arrays
+
+	def load_state_dict(self, config, arrays):
+		self.best = config["best"]
+		self.best_epoch = config["best_epoch"]
+		self.bad_evaluations = config["bad_evaluations"]
+		if "params" in arrays:
+			num_layers = sum(1 for k in arrays if k.startswith("running_mean_"))
+			self.best_params = np.array(arrays["params"])
+			self.best_running_means = [np.array(arrays["running_mean_{}".format(i)]) for i in range(num_layers)]
+			self.best_running_stds = [np.array(arrays["running_std_{}".format(i)]) for i in range(num_layers)]
+
+EVAL_STATS_BATCHES = 16
+
+def sample_batches(batches, num_batches=EVAL_STATS_BATCHES):
+	'''
+	Yield (batch_input, None) for num_batches contiguous training batches spread
+	evenly over the rows of a MinibatchShuffler or StreamingLoader. The rows are
+	read in file order and the random state is not touched, so re-estimating the
+	normalization statistics on them before a dev evaluation is cheap and does
+	not change the batches of the next epoch.
+	'''
+	inputs = batches.inputs
+	m = inputs.shape[0]
+	size = min(batches.batch_size, m)
+	transform = getattr(batches, "transform", None)
+	for start in np.unique(np.linspace(0, m - size, num_batches).astype(int)):
+		batch_input = np.array(inputs[start:start + size], dtype='float64')
+		if transform is not None:
+			batch_input = transform(batch_input)
+		yield batch_input, None
+
+def evaluate(net, inputs, target):
+	'''
+	Cross entropy loss and accuracy of net on (inputs, target) in eval mode.
+	The mode of net is left as it was.
+	'''
+	mode = net.mode
+	net.set_mode("eval")
+	pred = net.predict(inputs)
+	net.set_mode(mode)
+	accuracy = np.mean(np.argmax(pred, axis=1) == target.reshape(target.shape[0]))
+	return cross_entropy_loss(target, pred), accuracy
+
+CHECKPOINT_VERSION = 1
+
+def save_checkpoint(path, net, optimizer=None, scheduler=None, epoch=-1, preprocessor=None, early_stopping=None, config=None, **arrays):
+	'''
+	Save a checkpoint to the .npz file at path. The file is written next to path
+	and renamed over it, so an interrupted save never leaves a broken checkpoint.
+
+	It holds a JSON header (format version, architecture, epoch, optimizer
+	configuration, scheduler and early stopping state and the state of numpy's
+	global RNG) and arrays: the flat parameter buffer, the running
+	normalization statistics, the optimizer moments, the fitted preprocessor
+	and best early stopping snapshot (if given) and any extra arrays passed as
+	keyword arguments.
+
+	Parameters
+	----------
+		epoch : index of the last completed epoch
+		config : optional JSON-serializable description of the run (e.g. the
+				 hyper-parameters of a sweep trial), checked by load_checkpoint
+	'''
+	rng_name, rng_keys, rng_pos, rng_has_gauss, rng_cached_gaussian = np.random.get_state()
+	header = {
+		"version": CHECKPOINT_VERSION,
+		"net": {
+			"num_layers": net.num_layers, "num_units": net.num_units,
+			"output_nn": net.output_nn, "momentum": net.momentum,
+			"num_feats": net.num_feats,
+		},
+		"epoch": epoch,
+		"rng": [rng_name, rng_pos, rng_has_gauss, rng_cached_gaussian],
+		"extra": sorted(arrays),
+		"config": config,
+	}
+	out = {"params": net.params, "rng_keys": rng_keys}
+	for i in range(net.num_layers):
+		out["running_mean_{}".format(i)] = net.running_means[i]
+		out["running_std_{}".format(i)] = net.running_stds[i]
+	if optimizer is not None:
+		state = optimizer.state_dict()
+		header["optimizer"] = {k: state[k] for k in ("name", "config", "t")}
+		for k, v in state["state"].items():
+			out["optimizer_" + k] = v
+	if scheduler is not None:
+		header["scheduler"] = scheduler.state_dict()
+	if preprocessor is not None:
+		preprocessor_config, preprocessor_arrays = preprocessor.state_dict()
+		header["preprocessor"] = preprocessor_config
+		for k, v in preprocessor_arrays.items():
+			out["preprocessor_" + k] = v
+	if early_stopping is not None:
+		early_stopping_config, early_stopping_arrays = early_stopping.state_dict()
+		header["early_stopping"] = early_stopping_config
+		for k, v in early_stopping_arrays.items():
+			out["early_stopping_" + k] = v
+	for k, v in arrays.items():
+		out["extra_" + k] = v
+	out["header"] = np.array(json.dumps(header))
+
+	tmp_path = path + ".tmp"
+	with open(tmp_path, "wb") as f:
+		np.savez(f, **out)
+	os.replace(tmp_path, path)
+
+def load_checkpoint(path, net=None, optimizer=None, scheduler=None, restore_rng=True, preprocessor=None, early_stopping=None, config=None):
+	'''
+	Load a checkpoint written by save_checkpoint.
+
+	The state is restored in place into net, optimizer, scheduler,
+	preprocessor and early_stopping when they are given; net and optimizer are
+	otherwise created from the checkpoint. The RNG is restored too if
+	restore_rng.
+
+	A ValueError is raised if the checkpoint was saved with another config
+	(when config is given) or by an optimizer other than optimizer.
+
+	Returns
+	----------
+		net, optimizer (None if the checkpoint has none), the index of the last
+		completed epoch and a dict of the extra arrays, which also holds the
+		saved Preprocessor under "preprocessor" when none was given
+	'''
+	with np.load(path, allow_pickle=False) as f:
+		header = json.loads(str(f["header"]))
+		if header["version"] != CHECKPOINT_VERSION:
+			raise ValueError("{} has checkpoint version {}, expected {}".format(path, header["version"], CHECKPOINT_VERSION))
+		# Compared after a JSON round trip, as saved (tuples become lists)
+		if config is not None and header.get("config") != json.loads(json.dumps(config)):
+			raise ValueError("{} was saved with config {}, expected {}".format(path, header.get("config"), config))
+		if optimizer is not None and "optimizer" in header and header["optimizer"]["name"] != optimizer.name:
+			raise ValueError("{} holds {} optimizer state, the optimizer is {}".format(path, header["optimizer"]["name"], optimizer.name))
+
+		if net is None:
+			net = Net(**header["net"])
+		elif net.params.shape != f["params"].shape:
+			raise ValueError("{} holds {} parameters, the network has {}".format(path, f["params"].shape[0], net.params.shape[0]))
+		np.copyto(net.params, f["params"])
+		for i in range(net.num_layers):
+			np.copyto(net.running_means[i], f["running_mean_{}".format(i)])
+			np.copyto(net.running_stds[i], f["running_std_{}".format(i)])
+
+		if "optimizer" in header:
+			state = dict(header["optimizer"])
+			state["state"] = {k[len("optimizer_"):]: f[k] for k in f.files if k.startswith("optimizer_")}
+			if optimizer is None:
+				optimizer = make_optimizer(state["name"], **state["config"])
+			optimizer.load_state_dict(state)
+		if scheduler is not None and "scheduler" in header:
+			scheduler.load_state_dict(header["scheduler"])
+		if early_stopping is not None and "early_stopping" in header:
+			early_stopping.load_state_dict(header["early_stopping"], {
+				k[len("early_stopping_"):]: f[k] for k in f.files if k.startswith("early_stopping_")
+			})
+
+		saved_preprocessor = None
+		if "preprocessor" in header:
+			saved_preprocessor = preprocessor if preprocessor is not None else Preprocessor()
+			saved_preprocessor.load_state_dict(header["preprocessor"], {
+				k[len("preprocessor_"):]: f[k] for k in f.files if k.startswith("preprocessor_")
+			})
+		if restore_rng:
+			rng_name, rng_pos, rng_has_gauss, rng_cached_gaussian = header["rng"]
+			np.random.set_state((rng_name, f["rng_keys"], rng_pos, rng_has_gauss, rng_cached_gaussian))
+		extra = {k: f["extra_" + k] for k in header["extra"]}
+	if saved_preprocessor is not None and preprocessor is None:
+		extra["preprocessor"] = saved_preprocessor
+	return net, optimizer, header["epoch"], extra
 
 def min_max_scaling(X):
 	X = (X - 1922)/(2011 - 1922)
@@ -469,10 +1597,309 @@ def rmse(y, y_hat):
 	return loss
 
 
+def _shared_array(shape, dtype, blocks):
+	'''
+	numpy array of shape and dtype in a new block of shared memory, appended to blocks.
+	'''
+	block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+	blocks.append(block)
+	return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def _attach_array(name, shape, dtype, blocks):
+	block = shared_memory.SharedMemory(name=name)
+	blocks.append(block)
+	return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def _data_parallel_worker(index, arch, names, shapes, conn):
+	'''
+	Worker process of DataParallel: runs forward and backward on shard index of
+	every batch until it receives None.
+	'''
+	blocks = []
+	arrays = {k: _attach_array(names[k], shape, dtype, blocks) for k, (shape, dtype) in shapes.items()}
+	net = Net(*arch)
+	net.use_buffers(arrays["params"], arrays["grads"][index], copy=False)
+	net.running_means = [arrays["running_means"][index, i] for i in range(net.num_layers)]
+	net.running_stds = [arrays["running_stds"][index, i] for i in range(net.num_layers)]
+	while True:
+		message = conn.recv()
+		if message is None:
+			break
+		n, lamda = message
+		if n > 0:
+			shard_input = arrays["inputs"][index, :n]
+			shard_target = arrays["targets"][index, :n].reshape(n, 1)
+			net(shard_input, shard_target)
+			net.backward(shard_input, shard_target, lamda)
+			arrays["losses"][index] = net.loss
+		conn.send(True)
+	conn.close()
+	for block in blocks:
+		block.close()
+
+class DataParallel(object):
+	'''
+	Data-parallel forward and backward passes over a pool of worker processes.
+
+	Every batch is split into num_workers shards. The parameters live in shared
+	memory, so workers read the values written by Optimizer.step directly; each
+	worker writes its shard's gradients to its own row of a shared gradient
+	array, and step() averages them (weighted by shard size) into net.grads.
+
+	Normalization is done per shard: every worker normalizes with the statistics
+	of its own shard and keeps its own running averages, and the running
+	averages of net are the mean of the workers' (which, the averages being
+	linear, is the moving average of the mean shard statistics). After the
+	running averages of net are changed outside of step(), e.g. by
+	recompute_running_stats(), sync_running_stats() gives them back to the
+	workers, which then continue their moving averages from them.
+	'''
+
+	def __init__(self, net, num_workers, batch_size):
+		'''
+		Parameters
+		----------
+			net : Net to train; its parameters are moved to shared memory until close()
+			num_workers : number of worker processes
+			batch_size : largest batch passed to step()
+		'''
+		self.net = net
+		self.num_workers = num_workers
+		self.shard_size = -(-batch_size // num_workers)
+		self.blocks = []
+		units = (num_workers, net.num_layers, 1, net.num_units)
+		shapes = {
+			"params": (net.params.shape, net.params.dtype),
+			"grads": ((num_workers, net.params.shape[0]), net.params.dtype),
+			"inputs": ((num_workers, self.shard_size, net.weights[0].shape[0]), np.dtype('float64')),
+			"targets": ((num_workers, self.shard_size), np.dtype('int64')),
+			"losses": ((num_workers,), np.dtype('float64')),
+			"running_means": (units, np.dtype('float64')),
+			"running_stds": (units, np.dtype('float64')),
+		}
+		self.arrays = {k: _shared_array(shape, dtype, self.blocks) for k, (shape, dtype) in shapes.items()}
+		self.arrays["running_means"][...] = np.stack(net.running_means)
+		self.arrays["running_stds"][...] = np.stack(net.running_stds)
+		net.use_buffers(self.arrays["params"])
+		self.shard_weights = np.empty(num_workers)
+
+		names = {k: block.name for k, block in zip(shapes, self.blocks)}
+		arch = (net.num_layers, net.num_units, net.output_nn, net.momentum, net.num_feats)
+		self.conns = []
+		self.workers = []
+		for index in range(num_workers):
+			conn, worker_conn = multiprocessing.Pipe()
+			worker = multiprocessing.Process(
+				target=_data_parallel_worker, args=(index, arch, names, shapes, worker_conn), daemon=True
+			)
+			worker.start()
+			# Only the worker holds this end now, so recv() fails instead of
+			# blocking forever if the worker dies
+			worker_conn.close()
+			self.conns.append(conn)
+			self.workers.append(worker)
+
+	def _worker_failed(self, index):
+		worker = self.workers[index]
+		worker.join()
+		return RuntimeError("data-parallel worker {} exited with code {}".format(index, worker.exitcode))
+
+	def step(self, batch_input, batch_target, lamda):
+		'''
+		Forward and backward pass of one batch: afterwards net.grads holds the
+		gradients of the whole batch and net.loss its loss.
+		'''
+		m = batch_input.shape[0]
+		bounds = np.linspace(0, m, self.num_workers + 1).astype(int)
+		for index, conn in enumerate(self.conns):
+			start, end = bounds[index], bounds[index + 1]
+			self.arrays["inputs"][index, :end - start] = batch_input[start:end]
+			self.arrays["targets"][index, :end - start] = batch_target[start:end].reshape(-1)
+			self.shard_weights[index] = (end - start) / m
+			try:
+				conn.send((end - start, lamda))
+			except OSError:
+				raise self._worker_failed(index)
+		for index, conn in enumerate(self.conns):
+			try:
+				conn.recv()
+			except EOFError:
+				raise self._worker_failed(index)
+
+		np.dot(self.shard_weights, self.arrays["grads"], out=self.net.grads)
+		self.net.loss = np.dot(self.shard_weights, self.arrays["losses"])
+		for i in range(self.net.num_layers):
+			np.mean(self.arrays["running_means"][:, i], axis=0, out=self.net.running_means[i])
+			np.mean(self.arrays["running_stds"][:, i], axis=0, out=self.net.running_stds[i])
+
+	def sync_running_stats(self):
+		'''
+		Copy the running averages of net to every worker.
+		'''
+		self.arrays["running_means"][...] = np.stack(self.net.running_means)
+		self.arrays["running_stds"][...] = np.stack(self.net.running_stds)
+
+	def close(self):
+		'''
+		Stop the workers, move the parameters of net back to private memory and
+		free the shared memory.
+		'''
+		for conn in self.conns:
+			try:
+				conn.send(None)
+			except OSError:
+				pass  # the worker is already gone
+			conn.close()
+		for worker in self.workers:
+			worker.join()
+		self.net.use_buffers(np.empty_like(self.net.params))
+		for block in self.blocks:
+			block.close()
+			block.unlink()
+		self.blocks = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+def _hogwild_worker(index, num_workers, arch, optimizer_state, names, shapes, lamda, batch_size, max_epochs, seed):
+	'''
+	Worker process of hogwild_train: runs SGD on rows index, index + num_workers, ...
+	of the shared training data, updating the shared parameters without locks.
+	'''
+	blocks = []
+	arrays = {k: _attach_array(names[k], shape, dtype, blocks) for k, (shape, dtype) in shapes.items()}
+	np.random.seed(seed + index)
+	net = Net(*arch)
+	net.use_buffers(arrays["params"], copy=False)
+	net.running_means = [arrays["running_means"][index, i] for i in range(net.num_layers)]
+	net.running_stds = [arrays["running_stds"][index, i] for i in range(net.num_layers)]
+	optimizer = make_optimizer(optimizer_state["name"], **optimizer_state["config"])
+	optimizer.load_state_dict(optimizer_state)
+	if "Vt" in arrays:
+		optimizer.state = {"Vt": arrays["Vt"]}
+
+	m = arrays["inputs"].shape[0]
+	batches = MinibatchShuffler(arrays["inputs"], arrays["targets"], batch_size, rows=np.arange(index, m, num_workers))
+	samples, seconds, loss, num_batches = 0, 0.0, 0.0, 0
+	start = time.perf_counter()
+	net.set_mode("train")
+	for e in range(max_epochs):
+		for batch_input, batch_target in batches:
+			net(batch_input, batch_target)
+			net.backward(batch_input, batch_target, lamda)
+			optimizer.step(net.params, net.grads, net.segments)
+			samples += batch_input.shape[0]
+			loss += net.loss
+			num_batches += 1
+	arrays["stats"][index] = samples, time.perf_counter() - start, loss, num_batches
+	for block in blocks:
+		block.close()
+
+def hogwild_train(net, optimizer, lamda, batch_size, max_epochs, train_input, train_target, num_workers, seed=0):
+	'''
+	Asynchronous (Hogwild) training: num_workers processes each run max_epochs
+	of SGD over their own share of the rows, reading and updating parameters in
+	shared memory without any locking. With SGDMomentum the moving average of
+	the gradients is shared (and updated without locks) too.
+
+	Every worker normalizes with the statistics of its own batches and keeps
+	its own running averages; net gets their mean once all workers are done.
+
+	Parameters
+	----------
+		optimizer : an SGD or SGDMomentum optimizer, whose configuration and
+					state are used by every worker
+		seed : workers shuffle their rows with seeds seed, seed + 1, ...
+
+	Returns
+	----------
+		a list with the samples, seconds, samples per second and mean batch loss
+		of every worker
+	'''
+	if type(optimizer) not in (SGD, SGDMomentum):
+		raise ValueError("hogwild_train supports SGD and SGDMomentum, got {}".format(optimizer.name))
+	if optimizer.state is None:
+		optimizer.state = optimizer.init_state(net.params)
+
+	units = (num_workers, net.num_layers, 1, net.num_units)
+	shapes = {
+		"params": (net.params.shape, net.params.dtype),
+		"inputs": (train_input.shape, np.dtype('float64')),
+		"targets": ((train_input.shape[0],), np.dtype('int64')),
+		"running_means": (units, np.dtype('float64')),
+		"running_stds": (units, np.dtype('float64')),
+		"stats": ((num_workers, 4), np.dtype('float64')),
+	}
+	if "Vt" in optimizer.state:
+		shapes["Vt"] = (net.params.shape, net.params.dtype)
+	blocks = []
+	arrays = {}
+	try:
+		for k, (shape, dtype) in shapes.items():
+			arrays[k] = _shared_array(shape, dtype, blocks)
+		arrays["inputs"][...] = train_input
+		arrays["targets"][...] = np.asarray(train_target).reshape(-1)
+		arrays["running_means"][...] = np.stack(net.running_means)
+		arrays["running_stds"][...] = np.stack(net.running_stds)
+		arrays["stats"][...] = 0
+		if "Vt" in arrays:
+			arrays["Vt"][...] = optimizer.state["Vt"]
+		net.use_buffers(arrays["params"])
+
+		names = {k: block.name for k, block in zip(shapes, blocks)}
+		arch = (net.num_layers, net.num_units, net.output_nn, net.momentum, net.num_feats)
+		workers = [
+			multiprocessing.Process(
+				target=_hogwild_worker,
+				args=(index, num_workers, arch, optimizer.state_dict(), names, shapes, lamda, batch_size, max_epochs, seed),
+				daemon=True,
+			)
+			for index in range(num_workers)
+		]
+		for worker in workers:
+			worker.start()
+		for worker in workers:
+			worker.join()
+		for index, worker in enumerate(workers):
+			if worker.exitcode != 0:
+				raise RuntimeError("hogwild worker {} exited with code {}".format(index, worker.exitcode))
+
+		for i in range(net.num_layers):
+			np.mean(arrays["running_means"][:, i], axis=0, out=net.running_means[i])
+			np.mean(arrays["running_stds"][:, i], axis=0, out=net.running_stds[i])
+		if "Vt" in arrays:
+			np.copyto(optimizer.state["Vt"], arrays["Vt"])
+		optimizer.t += int(arrays["stats"][:, 3].sum())
+
+		throughput = []
+		for index, (samples, seconds, loss, num_batches) in enumerate(arrays["stats"]):
+			throughput.append({
+				"samples": int(samples), "seconds": seconds,
+				"samples_per_sec": samples / seconds if seconds > 0 else 0.0,
+				"loss": loss / max(1, num_batches),
+			})
+			print("Worker", index, "samples/sec", throughput[-1]["samples_per_sec"], "loss", throughput[-1]["loss"])
+		print("Total samples/sec", sum(t["samples_per_sec"] for t in throughput))
+		return throughput
+	finally:
+		# Move the parameters back to private memory before the shared blocks go away
+		if "params" in arrays and net.params is arrays["params"]:
+			net.use_buffers(np.empty_like(net.params))
+		for block in blocks:
+			block.close()
+			block.unlink()
+
+
 def train(
 	net, optimizer, lamda, batch_size, max_epochs,
 	train_input, train_target,
-	dev_input, dev_target
+	dev_input, dev_target, scheduler=None, early_stopping=None,
+	checkpoint_path=None, checkpoint_every=1, num_workers=1, dev_output="dev_test.csv",
+	preprocessor=None, resume=False, config=None
 ):
 	'''
 	In this function, you will perform following steps:
@@ -485,76 +1912,131 @@ def train(
 	Here we have added the code to loop over batches and perform backward pass
 	for each batch in the loop.
 	For this code also, you are free to heavily modify it.
-	'''
-
-	train_loss = []
-	dev_loss = []
-	m = train_input.shape[0]
-
-	for e in range(max_epochs):
-		epoch_loss = 0
-		train = np.hstack((train_input, train_target))
-		np.random.shuffle(train)
-		train_input = train[:, : -1]
-		train_target = train[:, -1]
-		train_target = train_target.reshape(train_target.shape[0], 1)
-		for i in range(0, m, batch_size):
-			batch_input = train_input[i:i+batch_size]
-			batch_target = train_target[i:i+batch_size]
-			batch_input = batch_input.astype('float64')
-			pred_one_hot = net(batch_input)
-			# print(pred)
-			# print(loss_mse(batch_target, pred))
-
-
-			# Compute gradients of loss w.r.t. weights and biases
-			dW, dgammas, dbetas = net.backward(batch_input, batch_target, lamda)
-
-
-
-			# Get updated weights based on current weights and gradients
-			weights_updated, gammas_updated, betas_updated = optimizer.step(net.weights, net.gammas, net.betas, dW, dgammas, dbetas)
-
-			# Update model's weights and biases
-			net.weights = weights_updated
-			net.gammas = gammas_updated
-			net.betas = betas_updated
 
-			# Compute loss for the batch
-			batch_loss = cross_entropy_loss(reg_to_one_hot(batch_target), pred_one_hot)
-			epoch_loss += batch_loss
-			# print(e, i, rmse(batch_target, pred), batch_loss)
+	train_input can also be a StreamingLoader, in which case train_target is
+	ignored and batches are streamed from disk.
 
+	scheduler is an optional LRScheduler, stepped after every batch or every
+	epoch according to its interval. early_stopping is an optional
+	EarlyStopping; when it stops training, the best parameters are restored.
 
-			# if i/256 == 1:
-			# 	break
-	# print(pred)
-		print(e, epoch_loss)
+	With checkpoint_path, a checkpoint is saved there every checkpoint_every
+	epochs (with the fitted preprocessor and the early stopping state, if
+	given). An existing checkpoint is overwritten unless resume is True, in
+	which case training resumes after its epoch; net and optimizer must then be
+	built as they were for the checkpoint. config is saved with the checkpoint
+	and resuming fails if it differs (see load_checkpoint).
 
+	With num_workers > 1, every batch is split across that many processes
+	(see DataParallel), so batch_size should be large.
 
-		# dev_pred_one_hot = net(dev_input)
-		# dev_pred = one_hot_to_reg(dev_pred_one_hot)
-		# print("Ratio : ", np.sum(dev_pred == dev_target)/dev_pred.shape[0])
-		# dev_loss = cross_entropy_loss(reg_to_one_hot(dev_target), dev_pred_one_hot)
-		# print("Dev loss ", dev_loss)
+	The dev predictions are written to dev_output (unless it is None) and the
+	dev loss is returned.
+	'''
 
-		'''
-		print(epoch_loss / (m / batch_size))
-		train_loss.append(epoch_loss / (m / batch_size))
-		dev_loss.append(dev_rmse)
-		'''
+	train_loss = []
+	dev_loss = []
 
-		# Write any early stopping conditions required (only for Part 2)
-		# Hint: You can also compute dev_rmse here and use it in the early
-		# 		stopping condition.
+	if isinstance(train_input, StreamingLoader):
+		batches = train_input
+	else:
+		batches = MinibatchShuffler(train_input, train_target, batch_size)
+
+	start_epoch = 0
+	if resume and checkpoint_path is not None and os.path.exists(checkpoint_path):
+		_, _, last_epoch, _ = load_checkpoint(checkpoint_path, net, optimizer, scheduler, early_stopping=early_stopping, config=config)
+		start_epoch = last_epoch + 1
+		print("Resuming from", checkpoint_path, "at epoch", start_epoch)
+
+	parallel = DataParallel(net, num_workers, batch_size) if num_workers > 1 else None
+	try:
+		net.set_mode("train")
+		for e in range(start_epoch, max_epochs):
+			epoch_loss = 0
+			for batch_input, batch_target in batches:
+				if parallel is not None:
+					# Forward and backward pass split across the workers
+					parallel.step(batch_input, batch_target, lamda)
+				else:
+					pred_one_hot = net(batch_input, batch_target)
+					# print(pred)
+					# print(loss_mse(batch_target, pred))
+
+
+					# Compute gradients of loss w.r.t. weights and biases (written to net.grads)
+					net.backward(batch_input, batch_target, lamda)
+
+				# Update model's weights and biases in place
+				optimizer.step(net.params, net.grads, net.segments)
+				if scheduler is not None and scheduler.interval == "step":
+					scheduler.step()
+
+				# Compute loss for the batch
+				batch_loss = net.loss
+				epoch_loss += batch_loss
+				# print(e, i, rmse(batch_target, pred), batch_loss)
+
+
+				# if i/256 == 1:
+				# 	break
+		# print(pred)
+			print(e, epoch_loss)
+
+			epoch_dev_loss = None
+			if (
+				(scheduler is not None and scheduler.interval == "epoch" and scheduler.needs_metric)
+				or (early_stopping is not None and early_stopping.should_evaluate(e))
+			):
+				# The moving averages lag behind the weights (see recompute_running_stats),
+				# which would make the dev loss look worse than it is
+				net.recompute_running_stats(sample_batches(batches))
+				if parallel is not None:
+					parallel.sync_running_stats()
+				epoch_dev_loss, epoch_dev_accuracy = evaluate(net, dev_input, dev_target)
+				print("Dev loss ", epoch_dev_loss, "accuracy ", epoch_dev_accuracy)
+
+			if scheduler is not None and scheduler.interval == "epoch":
+				scheduler.step(epoch_dev_loss)
+
+			# dev_pred_one_hot = net(dev_input)
+			# dev_pred = one_hot_to_reg(dev_pred_one_hot)
+			# print("Ratio : ", np.sum(dev_pred == dev_target)/dev_pred.shape[0])
+			# dev_loss = cross_entropy_loss(dev_target, dev_pred_one_hot)
+			# print("Dev loss ", dev_loss)
+
+			'''
+			print(epoch_loss / (m / batch_size))
+			train_loss.append(epoch_loss / (m / batch_size))
+			dev_loss.append(dev_rmse)
+			'''
+
+			stop = False
+			if early_stopping is not None and early_stopping.should_evaluate(e):
+				stop = early_stopping.update(net, e, epoch_dev_loss, epoch_dev_accuracy)
+
+			if checkpoint_path is not None and (e + 1) % checkpoint_every == 0:
+				save_checkpoint(checkpoint_path, net, optimizer, scheduler, e, preprocessor, early_stopping, config)
+
+			if stop:
+				print("Early stopping at epoch", e, "best epoch", early_stopping.best_epoch)
+				break
+	finally:
+		if parallel is not None:
+			parallel.close()
+
+	if early_stopping is not None:
+		early_stopping.restore(net)
 
 	# After running `max_epochs` (for Part 1) epochs OR early stopping (for Part 2), compute the RMSE on dev data.
 
 	# '''
-	dev_pred_one_hot = net(dev_input)
+	net.recompute_running_stats(batches)
+	net.set_mode("eval")
+	dev_pred_one_hot = net.predict(dev_input)
 	dev_pred = one_hot_to_reg(dev_pred_one_hot)
-	pd.DataFrame(np.concatenate((dev_pred, dev_target), axis=1)).to_csv("dev_test.csv")
-	dev_loss = cross_entropy_loss(reg_to_one_hot(dev_target), dev_pred_one_hot)
+	if dev_output is not None:
+		pd.DataFrame(np.concatenate((dev_pred, decode_labels(dev_target)), axis=1)).to_csv(dev_output)
+	dev_loss = cross_entropy_loss(dev_target, dev_pred_one_hot)
 	print("Dev loss", dev_loss)
 
 	'''
@@ -564,6 +2046,7 @@ def train(
 	plt.plot(np.arange(0, 100), dev_loss, label="Dev RMSE Loss")
 	plt.savefig("dev_" + str(batch_size) + ".png")
 	'''
+	return dev_loss
 
 def reverse_min_max(X):
 	X = X * (2011 - 1922) + 1922
@@ -577,7 +2060,7 @@ def get_test_data_predictions(net, inputs):
 
 	Parameters
 	----------
-		net : trained neural network
+		net : trained neural network (a Net or the FoldedNet from net.fold())
 		inputs : test input, numpy array of shape m x d
 
 	Returns
@@ -585,52 +2068,611 @@ def get_test_data_predictions(net, inputs):
 		predictions (optional): Predictions obtained from forward pass
 								on test data, numpy array of shape m x 1
 	'''
-	pred = one_hot_to_reg(net(inputs))
+	pred = one_hot_to_reg(net.predict(inputs))
 	# print(pred)
 	pd.DataFrame(pred).to_csv("test_test_class.csv")
 
+_worker_model = None
 
-X_mean = None
-X_std = None
-def normalize(X, train):
-	global X_mean, X_std
+def _init_predict_worker(model_path):
+	global _worker_model
+	_worker_model = FoldedNet.load(model_path)
 
-	if train == True:
-		X_mean = X.mean()
-		X_std = X.std()
-		# X = X[(np.abs(stats.zscore(X)) < 2).all(axis=1)]
-		print(X.shape)
-		return (X-X.mean())/(X.std())# + 0.00000001)
-	else:
-		return (X-X_mean)/(X_std)
+def _predict_chunk(X):
+	return _worker_model.predict(X)
 
-def read_data():
+def parallel_predict(model_path, inputs, num_workers=None, chunk_size=PREDICT_CHUNK_ROWS):
 	'''
-	Read the train, dev, and test datasets
+	Class probabilities of a model saved with FoldedNet.save, computed by a pool
+	of num_workers processes. Every worker memory-maps the model file once, so
+	the weights are shared between them instead of being copied into each.
+
+	Parameters
+	----------
+		model_path : path passed to FoldedNet.save
+		inputs : numpy (or memory-mapped) array of shape m x d
+		num_workers : number of processes, defaults to the number of CPUs
+		chunk_size : number of rows sent to a worker at a time
 	'''
-	df_train = pd.read_csv('22m0754/classification/data/train.csv')
-	df_dev = pd.read_csv('22m0754/classification/data/dev.csv')
-	test_input = pd.read_csv('22m0754/classification/data/test.csv')  # .to_numpy()
+	m = inputs.shape[0]
+	chunks = [inputs[start:start + chunk_size] for start in range(0, m, chunk_size)]
+	with multiprocessing.Pool(num_workers, _init_predict_worker, (model_path,)) as pool:
+		return np.concatenate(pool.map(_predict_chunk, chunks), axis=0)
 
 
-	train_input = normalize(df_train.iloc[:, 1:], True).to_numpy()
-	# train_input = pca.fit_transform(train_input)
+CACHE_DIR = '.npy_cache'
+CACHE_VERSION = 2
+INGEST_CHUNK_ROWS = 100000
 
-	test_input = normalize(test_input,False).to_numpy()
-	# test_input = pca.transform(test_input)
+def _cache_dir(path, usecols=None):
+	name = os.path.basename(path)
+	if usecols is not None:
+		# Every column subset gets its own cache
+		name += '.' + hashlib.sha1(json.dumps(sorted(set(c.strip() for c in usecols))).encode()).hexdigest()[:12]
+	return os.path.join(os.path.dirname(path), CACHE_DIR, name)
 
-	# explained_variance = pca.explained_variance_ratio_
-	# print(explained_variance)
+def _source_key(path):
+	stat = os.stat(path)
+	return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def _count_rows(path, chunk_size=INGEST_CHUNK_ROWS):
+	'''
+	Number of data rows pandas parses from the csv file at path. Counting raw
+	newlines would also count blank lines and line breaks inside quoted fields,
+	so the rows are counted by a chunked pass over the first column instead.
+	'''
+	return sum(chunk.shape[0] for chunk in pd.read_csv(path, usecols=[0], chunksize=chunk_size))
+
+def ingest_csv(path, has_target=True, chunk_size=INGEST_CHUNK_ROWS, usecols=None):
+	'''
+	Parse a csv file once and store it as contiguous .npy arrays, together with
+	a manifest recording the size and mtime of the csv it was built from.
+	The csv is parsed `chunk_size` rows at a time straight into the .npy files,
+	so files larger than memory can be ingested.
+
+	Parameters
+	----------
+		path : path of the csv file
+		has_target : True if the first column of the csv is the target
+		chunk_size : number of csv rows parsed at a time
+		usecols : names of the input columns to keep (surrounding spaces are
+				  ignored), None for all. The other columns are not parsed.
+
+	Returns
+	----------
+		manifest : dict describing the cached arrays
+	'''
+	cache_dir = _cache_dir(path, usecols)
+	manifest_path = os.path.join(cache_dir, 'manifest.json')
+	os.makedirs(cache_dir, exist_ok=True)
+	if os.path.exists(manifest_path):
+		os.remove(manifest_path)
+
+	source = _source_key(path)
+	rows = _count_rows(path, chunk_size)
+	header = [str(c) for c in pd.read_csv(path, nrows=0).columns]
+	columns = header[1:] if has_target else header
+	read_columns = None
+	if usecols is not None:
+		wanted = set(name.strip() for name in usecols)
+		missing = wanted - set(c.strip() for c in columns)
+		if missing:
+			raise ValueError("{} has no columns {}".format(path, sorted(missing)))
+		# pandas returns usecols in file order, so keep that order
+		columns = [c for c in columns if c.strip() in wanted]
+		read_columns = (header[:1] if has_target else []) + columns
+
+	inputs = np.lib.format.open_memmap(os.path.join(cache_dir, 'inputs.npy'), mode='w+', dtype='float64', shape=(rows, len(columns)))
+	target = None
+	start = 0
+	for chunk in pd.read_csv(path, chunksize=chunk_size, usecols=read_columns):
+		end = start + chunk.shape[0]
+		if end > rows:
+			raise ValueError("{} has more rows than expected".format(path))
+		if has_target:
+			values = chunk.iloc[:, 0].to_numpy()
+			if values.dtype == object:
+				# Class names are stored as their integer class index
+				values = encode_labels(values).reshape(chunk.shape[0])
+			if target is None:
+				target = np.lib.format.open_memmap(os.path.join(cache_dir, 'target.npy'), mode='w+', dtype=values.dtype, shape=(rows,))
+			target[start:end] = values
+			chunk = chunk.iloc[:, 1:]
+		inputs[start:end] = chunk.to_numpy(dtype='float64')
+		start = end
+	if start != rows:
+		raise ValueError("{} has {} rows, expected {}".format(path, start, rows))
+	if has_target and target is None:
+		np.save(os.path.join(cache_dir, 'target.npy'), np.empty((0,)))
+	inputs.flush()
+	if target is not None:
+		target.flush()
+
+	manifest = {
+		"version": CACHE_VERSION, "source": source, "has_target": has_target,
+		"usecols": None if usecols is None else sorted(wanted), "columns": columns,
+	}
+	with open(manifest_path + '.tmp', 'w') as f:
+		json.dump(manifest, f)
+	os.replace(manifest_path + '.tmp', manifest_path)
+	return manifest
+
+def load_csv(path, has_target=True, usecols=None):
+	'''
+	Load a csv file through the binary cache. The csv is only parsed when the
+	cache is missing or the csv changed since it was ingested.
+
+	Parameters
+	----------
+		path : path of the csv file
+		has_target : True if the first column of the csv is the target
+		usecols : names of the input columns to load (see ingest_csv), None for all.
+				  Their names, in the order of the returned columns, are given by
+				  csv_columns(path, usecols).
+
+	Returns
+	----------
+		inputs : read-only memory-mapped float64 array of shape m x d
+		target : read-only memory-mapped array of shape m, None if has_target is False.
+				 Class names are returned as int8 class indices (see encode_labels).
+	'''
+	cache_dir = _cache_dir(path, usecols)
+	manifest_path = os.path.join(cache_dir, 'manifest.json')
+	manifest = None
+	if os.path.exists(manifest_path):
+		with open(manifest_path) as f:
+			manifest = json.load(f)
+	if manifest is None or manifest.get("version") != CACHE_VERSION or manifest["source"] != _source_key(path) \
+			or manifest["has_target"] != has_target:
+		manifest = ingest_csv(path, has_target, usecols=usecols)
+
+	inputs = np.load(os.path.join(cache_dir, 'inputs.npy'), mmap_mode='r')
+	target = None
+	if has_target:
+		target = np.load(os.path.join(cache_dir, 'target.npy'), mmap_mode='r')
+	return inputs, target
+
+class StreamingLoader(object):
+	'''
+	Minibatch loader for training sets that do not fit in memory.
+
+	Rows are read from (memory-mapped) arrays `chunk_size` rows at a time.
+	Every epoch the chunk order is shuffled, `buffer_chunks` chunks are copied
+	into a shuffle buffer, and the buffer rows are shuffled before being cut
+	into batches. At most buffer_chunks * chunk_size + batch_size rows are held
+	in memory, whatever the size of the dataset.
+	'''
+
+	def __init__(self, inputs, target, batch_size, chunk_size=65536, buffer_chunks=4, transform=None):
+		'''
+		Parameters
+		----------
+			inputs : array of shape m x d, usually memory-mapped by load_csv
+			target : array of shape m
+			batch_size : number of rows per yielded batch
+			chunk_size : number of contiguous rows read from disk at a time
+			buffer_chunks : number of chunks shuffled together
+			transform : optional function applied to the input rows once they are in the buffer,
+						e.g. preprocessor.transform
+		'''
+		self.inputs = inputs
+		self.target = target
+		self.batch_size = batch_size
+		self.chunk_size = chunk_size
+		self.buffer_chunks = buffer_chunks
+		self.transform = transform
+
+		buffer_rows = chunk_size * buffer_chunks + batch_size
+		self.input_buffer = np.empty((buffer_rows, inputs.shape[1]))
+		self.target_buffer = np.empty((buffer_rows,), dtype=target.dtype)
+
+	@classmethod
+	def from_csv(cls, path, batch_size, **kwargs):
+		'''
+		Build a loader over a csv file, going through the binary cache of load_csv.
+		'''
+		inputs, target = load_csv(path)
+		return cls(inputs, target, batch_size, **kwargs)
+
+	def __len__(self):
+		return self.inputs.shape[0]
+
+	def __iter__(self):
+		'''
+		Yield (batch_input, batch_target) for one epoch. The batches are views into
+		the shuffle buffer and are only valid until the next batch is requested.
+		'''
+		m = self.inputs.shape[0]
+		starts = np.arange(0, m, self.chunk_size)
+		np.random.shuffle(starts)
+
+		carry = 0
+		for c in range(0, len(starts), self.buffer_chunks):
+			filled = carry
+			for start in starts[c:c + self.buffer_chunks]:
+				end = min(start + self.chunk_size, m)
+				self.input_buffer[filled:filled + end - start] = self.inputs[start:end]
+				self.target_buffer[filled:filled + end - start] = self.target[start:end]
+				filled += end - start
+			if self.transform is not None:
+				self.input_buffer[carry:filled] = self.transform(self.input_buffer[carry:filled])
+
+			perm = np.random.permutation(filled)
+			self.input_buffer[:filled] = self.input_buffer[perm]
+			self.target_buffer[:filled] = self.target_buffer[perm]
+
+			# Rows that do not fill a whole batch are carried over to the next buffer
+			if c + self.buffer_chunks >= len(starts):
+				full = filled
+			else:
+				full = filled - filled % self.batch_size
+			for i in range(0, full, self.batch_size):
+				j = min(i + self.batch_size, full)
+				yield self.input_buffer[i:j], self.target_buffer[i:j].reshape(j - i, 1)
+
+			carry = filled - full
+			self.input_buffer[:carry] = self.input_buffer[full:filled]
+			self.target_buffer[:carry] = self.target_buffer[full:filled]
+
+
+class MinibatchShuffler(object):
+	'''
+	Shuffles in-memory training data through a permutation of row indices.
+
+	The inputs are kept as one contiguous float64 array and are never reordered;
+	each batch is gathered with np.take into preallocated buffers, so an epoch
+	allocates nothing proportional to the size of the dataset.
+	'''
+
+	def __init__(self, inputs, target, batch_size, rows=None):
+		'''
+		Parameters
+		----------
+			inputs : numpy array of shape m x d
+			target : numpy array of shape m x 1 (or m)
+			batch_size : number of rows per yielded batch
+			rows : sorted indices of the rows to draw batches from, defaults to all
+		'''
+		self.inputs = np.ascontiguousarray(inputs, dtype='float64')
+		self.target = np.ascontiguousarray(target).reshape(-1)
+		self.batch_size = batch_size
+		self.order = np.arange(self.inputs.shape[0]) if rows is None else np.array(rows)
+
+		self.input_buffer = np.empty((batch_size, self.inputs.shape[1]))
+		self.target_buffer = np.empty((batch_size,), dtype=self.target.dtype)
+
+	def __len__(self):
+		return self.order.shape[0]
+
+	def __iter__(self):
+		'''
+		Yield (batch_input, batch_target) for one epoch. The batches are views into
+		the gather buffers and are only valid until the next batch is requested.
+		'''
+		# Start sorted so the epoch's order depends only on the RNG
+		# state, which makes training resumed from a checkpoint reproducible
+		self.order.sort()
+		np.random.shuffle(self.order)
+		for i in range(0, self.order.shape[0], self.batch_size):
+			index = self.order[i:i+self.batch_size]
+			n = index.shape[0]
+			np.take(self.inputs, index, axis=0, out=self.input_buffer[:n])
+			np.take(self.target, index, out=self.target_buffer[:n])
+			yield self.input_buffer[:n], self.target_buffer[:n].reshape(n, 1)
+
+
+def read_feature_list(path='features.csv'):
+	'''
+	Names of the features listed in path, one per line.
+	'''
+	with open(path) as f:
+		return [line.strip() for line in f if line.strip()]
+
+def csv_columns(path, usecols=None):
+	'''
+	Names of the input columns of a csv file loaded with load_csv(path, ..., usecols),
+	with surrounding spaces removed.
+	'''
+	with open(os.path.join(_cache_dir(path, usecols), 'manifest.json')) as f:
+		return [c.strip() for c in json.load(f)["columns"]]
+
+def write_feature_list(features, path='features.csv'):
+	'''
+	Write feature names one per line, in the format read by read_feature_list.
+	'''
+	with open(path, 'w') as f:
+		for name in features:
+			f.write(" {}\n".format(name))
+
+def rank_features_by_variance(X, columns, chunk_size=PREDICT_CHUNK_ROWS):
+	'''
+	Features (columns of X) ranked by decreasing variance, as a pandas Series of
+	variances indexed by name. Constant and near-constant columns come last.
+	'''
+	moments = column_moments(X, chunk_size)
+	return pd.Series(moments.std() ** 2, index=columns).sort_values(ascending=False)
+
+def rank_features_by_mutual_information(X, y, columns, max_rows=100000, seed=0):
+	'''
+	Features ranked by decreasing mutual information with the class y, as a
+	pandas Series indexed by name, estimated on at most max_rows random rows.
+	'''
+	m = X.shape[0]
+	rows = np.sort(np.random.RandomState(seed).choice(m, max_rows, replace=False)) if m > max_rows else np.arange(m)
+	scores = mutual_info_classif(np.asarray(X[rows], dtype='float64'), np.asarray(y).reshape(-1)[rows], random_state=seed)
+	return pd.Series(scores, index=columns).sort_values(ascending=False)
+
+def rank_features_by_weights(net, preprocessor):
+	'''
+	Features ranked by the magnitude of the first layer weights of a trained
+	net, as a pandas Series indexed by name. The weights are taken through the
+	preprocessor (including PCA) back to the standardized input columns, where
+	the score of a column is the norm of its row of weights.
+	'''
+	# preprocessor.matrix rows are scaled by 1 / std; scale back to standardized inputs
+	weights = np.dot(preprocessor.matrix[preprocessor.index], net.weights[0]) * preprocessor.std[:, None]
+	scores = np.linalg.norm(weights, axis=1)
+	return pd.Series(scores, index=[preprocessor.columns[i] for i in preprocessor.index]).sort_values(ascending=False)
+
+class RunningMoments(object):
+	'''
+	Per-column count, mean and sum of squared deviations (m2), accumulated one
+	chunk of rows at a time in bounded memory.
+
+	Chunks, and moments accumulated separately (e.g. by other processes), are
+	combined with the pairwise update of Chan et al., the chunked form of
+	Welford's algorithm, which stays accurate where sum(x^2) - n * mean^2 would
+	cancel catastrophically.
+	'''
+
+	def __init__(self, d):
+		self.count = 0
+		self.mean = np.zeros(d)
+		self.m2 = np.zeros(d)
+
+	def update(self, chunk):
+		'''
+		Add the rows of chunk (numpy array of shape n x d).
+		'''
+		chunk = np.asarray(chunk, dtype='float64')
+		if chunk.shape[0] == 0:
+			return self
+		mean = chunk.mean(axis=0)
+		m2 = np.square(chunk - mean).sum(axis=0)
+		return self.merge(chunk.shape[0], mean, m2)
+
+	def merge(self, count, mean, m2):
+		'''
+		Add the moments (count, mean, m2) of other rows.
+		'''
+		total = self.count + count
+		if total == 0:
+			return self
+		delta = mean - self.mean
+		self.m2 += m2 + np.square(delta) * (self.count * count / total)
+		self.mean += delta * (count / total)
+		self.count = total
+		return self
+
+	def std(self, ddof=1):
+		return np.sqrt(self.m2 / (self.count - ddof))
+
+def _array_moments(X, start, end, chunk_size):
+	moments = RunningMoments(X.shape[1])
+	for chunk_start in range(start, end, chunk_size):
+		moments.update(X[chunk_start:min(chunk_start + chunk_size, end)])
+	return moments
+
+def _npy_moments(args):
+	path, start, end, chunk_size = args
+	moments = _array_moments(np.load(path, mmap_mode='r'), start, end, chunk_size)
+	return moments.count, moments.mean, moments.m2
+
+def column_moments(X, chunk_size=PREDICT_CHUNK_ROWS, num_workers=1):
+	'''
+	RunningMoments of the columns of X, read chunk_size rows at a time.
+
+	Parameters
+	----------
+		X : numpy array, array memory-mapped from a .npy file (as returned by
+			load_csv) or path of a .npy file
+		num_workers : with more than one, the rows are split in num_workers
+					  ranges whose moments are computed by a pool of processes
+					  (each memory-mapping the file) and merged. Needs X to be
+					  backed by a .npy file.
+	'''
+	if isinstance(X, str):
+		path = X
+		X = np.load(path, mmap_mode='r')
+	else:
+		path = getattr(X, "filename", None)
+	m, d = X.shape
+	if num_workers <= 1:
+		return _array_moments(X, 0, m, chunk_size)
+	if path is None:
+		raise ValueError("parallel moments need X memory-mapped from a .npy file")
+	bounds = np.linspace(0, m, num_workers + 1).astype(int)
+	tasks = [(path, bounds[i], bounds[i + 1], chunk_size) for i in range(num_workers)]
+	moments = RunningMoments(d)
+	with multiprocessing.Pool(num_workers) as pool:
+		for count, mean, m2 in pool.map(_npy_moments, tasks):
+			moments.merge(count, mean, m2)
+	return moments
+
+def csv_moments(path, has_target=True, chunk_size=INGEST_CHUNK_ROWS):
+	'''
+	RunningMoments of the input columns of a csv file, parsed chunk_size rows
+	at a time without building the binary cache.
+	'''
+	moments = None
+	for df in pd.read_csv(path, chunksize=chunk_size):
+		if has_target:
+			df = df.iloc[:, 1:]
+		if moments is None:
+			moments = RunningMoments(df.shape[1])
+		moments.update(df.to_numpy(dtype='float64'))
+	return moments
+
+class Preprocessor(object):
+	'''
+	Input preprocessing, fitted once on the training data: standardization of
+	every column, optional selection of a subset of the features and optional
+	PCA of the standardized features. columns records the names of the raw
+	input columns it expects, in order.
+
+	All three steps are affine, so they are collapsed into one: transform(X) is
+	X @ matrix + offset, a single matmul over the raw rows. The fitted state is
+	plain arrays, saved in checkpoints (save_checkpoint) and folded into the
+	first layer of an exported model by Net.fold.
+	'''
+
+	def __init__(self, features=None, n_components=None):
+		'''
+		Parameters
+		----------
+			features : names of the columns to keep (e.g. read_feature_list()),
+					   None for all of them
+			n_components : number of PCA components to keep or, if between 0 and
+						   1, the explained variance ratio they must reach. None
+						   for no PCA.
+		'''
+		self.features = features
+		self.n_components = n_components
+		self.columns = None
+		self.index = None
+		self.mean = None
+		self.std = None
+		self.components = None
+		self.matrix = None
+		self.offset = None
+
+	@property
+	def num_outputs(self):
+		return self.matrix.shape[1]
+
+	def fit(self, X, columns=None, chunk_size=PREDICT_CHUNK_ROWS, num_workers=1):
+		'''
+		Fit on the training inputs X (numpy or memory-mapped, m x d), read
+		chunk_size rows at a time. columns are the names of the columns of X,
+		needed to select features (see csv_columns). The column statistics are
+		streamed (see column_moments, which also explains num_workers).
+		'''
+		m, d = X.shape
+		self.columns = list(columns) if columns is not None else [str(i) for i in range(d)]
+		if self.features is None:
+			self.index = np.arange(d)
+		else:
+			if columns is None:
+				raise ValueError("selecting features needs the column names of X")
+			missing = [name for name in self.features if name not in columns]
+			if missing:
+				raise ValueError("features not in the data: {}".format(missing))
+			self.index = np.array([columns.index(name) for name in self.features])
+
+		moments = column_moments(X, chunk_size, num_workers)
+		std = moments.std()
+		std[std == 0] = 1
+		self.mean = moments.mean[self.index]
+		self.std = std[self.index]
+
+		# Standardization and selection as one d x k matrix, then PCA on top of it
+		self.matrix = np.zeros((d, self.index.shape[0]))
+		self.matrix[self.index, np.arange(self.index.shape[0])] = 1 / self.std
+		self.offset = -(self.mean / self.std).reshape(1, -1)
+		self.components = None
+		if self.n_components is not None:
+			self.components = self.fit_pca(X, chunk_size)
+			self.matrix = np.dot(self.matrix, self.components.T)
+			self.offset = np.dot(self.offset, self.components.T)
+		return self
+
+	def fit_pca(self, X, chunk_size):
+		'''
+		Principal directions (as rows, by decreasing variance) of the
+		standardized, selected features.
+		'''
+		m = X.shape[0]
+		k = self.index.shape[0]
+		covar = np.zeros((k, k))
+		for start in range(0, m, chunk_size):
+			Z = (np.asarray(X[start:start + chunk_size], dtype='float64')[:, self.index] - self.mean) / self.std
+			covar += np.dot(Z.T, Z)
+		covar /= m - 1
+		eig_val, eig_vec = np.linalg.eigh(covar)
+		order = np.argsort(eig_val)[::-1]
+		eig_val, eig_vec = eig_val[order], eig_vec[:, order]
+		if 0 < self.n_components < 1:
+			curve = np.cumsum(eig_val) / np.sum(eig_val)
+			n = min(k, int(np.searchsorted(curve, self.n_components * (1 - 1e-12))) + 1)
+		else:
+			n = int(self.n_components)
+		return eig_vec[:, :n].T
+
+	def transform(self, X, chunk_size=PREDICT_CHUNK_ROWS):
+		'''
+		Preprocess X (numpy or memory-mapped, m x d) chunk_size rows at a time.
+		'''
+		m = X.shape[0]
+		out = np.empty((m, self.num_outputs))
+		for start in range(0, m, chunk_size):
+			end = min(start + chunk_size, m)
+			np.dot(np.asarray(X[start:end], dtype='float64'), self.matrix, out=out[start:end])
+		out += self.offset
+		return out
+
+	def state_dict(self):
+		'''
+		The fitted state, as a JSON-serializable config and a dict of arrays.
+		'''
+		config = {"features": self.features, "n_components": self.n_components, "columns": self.columns}
+		arrays = {"index": self.index, "mean": self.mean, "std": self.std, "matrix": self.matrix, "offset": self.offset}
+		if self.components is not None:
+			arrays["components"] = self.components
+		return config, arrays
+
+	def load_state_dict(self, config, arrays):
+		self.features = config["features"]
+		self.n_components = config["n_components"]
+		self.columns = config["columns"]
+		self.index = np.array(arrays["index"])
+		self.mean = np.array(arrays["mean"])
+		self.std = np.array(arrays["std"])
+		self.matrix = np.array(arrays["matrix"])
+		self.offset = np.array(arrays["offset"])
+		self.components = np.array(arrays["components"]) if "components" in arrays else None
+
+
+def read_data(features=None, n_components=None):
+	'''
+	Read the train, dev, and test datasets, preprocessed by a Preprocessor
+	fitted on the training inputs (see Preprocessor for n_components).
+
+	With features (e.g. read_feature_list() for the columns of features.csv,
+	or the top of a ranking from rank_features_by_*), only those columns are
+	parsed and loaded, and the width of the inputs is the number of features.
+
+	Returns
+	----------
+		train_input, train_target, dev_input, dev_target, test_input and the
+		fitted Preprocessor
+	'''
+	train_input, train_target = load_csv('22m0754/classification/data/train.csv', usecols=features)
+	dev_input, dev_target = load_csv('22m0754/classification/data/dev.csv', usecols=features)
+	test_input, _ = load_csv('22m0754/classification/data/test.csv', False, usecols=features)
+
+	preprocessor = Preprocessor(n_components=n_components)
+	preprocessor.fit(train_input, csv_columns('22m0754/classification/data/train.csv', features))
+	print(train_input.shape)
+
+	train_input = preprocessor.transform(train_input)
+	test_input = preprocessor.transform(test_input)
 
-	train_target = (df_train.iloc[:, 0]).to_numpy()
 	train_target = train_target.reshape(train_target.shape[0], 1)
 	# train_target = min_max_scaling(train_target)
-	dev_input = normalize(df_dev.iloc[:, 1:], False).to_numpy()
-	# dev_input = pca.transform(dev_input)
-	dev_target = (df_dev.iloc[:, 0]).to_numpy()
+	dev_input = preprocessor.transform(dev_input)
 	dev_target = dev_target.reshape(dev_target.shape[0], 1)
 	# dev_target = min_max_scaling(dev_target)
-	return train_input, train_target, dev_input, dev_target, test_input
+	return train_input, train_target, dev_input, dev_target, test_input, preprocessor
 
 
 
@@ -638,20 +2680,178 @@ def read_data_non_normalize():
 	'''
 	Read the train, dev, and test datasets
 	'''
-	df_train = pd.read_csv('22m0754/classification/data/train.csv')
-	df_dev = pd.read_csv('22m0754/classification/data/dev.csv')
-	test_input = pd.read_csv('22m0754/classification/data/test.csv')  # .to_numpy()
-	
-	test_input = (test_input).to_numpy()
+	train_input, train_target = load_csv('22m0754/classification/data/train.csv')
+	dev_input, dev_target = load_csv('22m0754/classification/data/dev.csv')
+	test_input, _ = load_csv('22m0754/classification/data/test.csv', False)
 
-	train_input = (df_train.iloc[:, 1:]).to_numpy()
-	train_target = df_train.iloc[:, 0].to_numpy()
 	train_target = train_target.reshape(train_target.shape[0], 1)
-	dev_input = (df_dev.iloc[:, 1:]).to_numpy()
-	dev_target = df_dev.iloc[:, 0].to_numpy()
 	dev_target = dev_target.reshape(dev_target.shape[0], 1)
 	return train_input, train_target, dev_input, dev_target, test_input
 
+# Search space of the configurations tried by hand (see the notes in main()).
+# Keys "<optimizer>.<argument>" are optimizer arguments, used only with that optimizer.
+SEARCH_SPACE = {
+	"learning_rate": [0.001, 0.002, 0.005, 0.01],
+	"batch_size": [64, 256],
+	"num_layers": [1, 2, 4],
+	"num_units": [64, 100],
+	"lamda": [0.0, 0.0001],
+	"optimizer": ["SGDMomentum", "RMSProp", "ADAM"],
+	"SGDMomentum.beta": [0.9],
+	"RMSProp.beta": [0.9, 0.999],
+	"ADAM.beta1": [0.9],
+	"ADAM.beta2": [0.99, 0.999],
+}
+# Values of the hyper-parameters a search space leaves out, as in main()
+TRIAL_DEFAULTS = {
+	"learning_rate": 0.002,
+	"batch_size": 64,
+	"num_layers": 4,
+	"num_units": 100,
+	"lamda": 0.0,
+	"optimizer": "ADAM",
+}
+TRIAL_KEYS = tuple(TRIAL_DEFAULTS)
+
+def sample_configs(space, num_trials=None, seed=0):
+	'''
+	Configurations drawn from space, a dict mapping every hyper-parameter to a
+	list of values: the whole grid if num_trials is None, otherwise num_trials
+	random draws. Optimizer arguments of other optimizers are left out, and
+	hyper-parameters missing from space take their TRIAL_DEFAULTS value.
+	'''
+	space = dict({k: [v] for k, v in TRIAL_DEFAULTS.items() if k not in space}, **space)
+	keys = sorted(space)
+	if num_trials is None:
+		grid = [dict()]
+		for k in keys:
+			grid = [dict(config, **{k: v}) for config in grid for v in space[k]]
+		configs = grid
+	else:
+		rng = np.random.RandomState(seed)
+		configs = [{k: space[k][rng.randint(len(space[k]))] for k in keys} for i in range(num_trials)]
+
+	unique = []
+	for config in configs:
+		config = {
+			k: v for k, v in config.items()
+			if "." not in k or k.split(".", 1)[0] == config["optimizer"]
+		}
+		if config not in unique:
+			unique.append(config)
+	return unique
+
+def _sweep_trial(args):
+	'''
+	Train trial trial_id of a sweep to epochs epochs (resuming from its
+	checkpoint) on the memory-mapped dataset in out_dir.
+	'''
+	trial_id, config, epochs, out_dir, seed = args
+	data = {
+		k: np.load(os.path.join(out_dir, k + ".npy"), mmap_mode='r')
+		for k in ("train_input", "train_target", "dev_input", "dev_target")
+	}
+	np.random.seed(seed + trial_id)
+	net = Net(config["num_layers"], config["num_units"], NUM_CLASS, num_feats=data["train_input"].shape[1])
+	optimizer = make_optimizer(
+		config["optimizer"], config["learning_rate"],
+		**{k.split(".", 1)[1]: v for k, v in config.items() if "." in k}
+	)
+	dev_loss = train(
+		net, optimizer, config["lamda"], config["batch_size"], epochs,
+		data["train_input"], data["train_target"],
+		data["dev_input"], data["dev_target"],
+		checkpoint_path=os.path.join(out_dir, "trial_{}.npz".format(trial_id)),
+		dev_output=None, resume=True, config=config
+	)
+	_, dev_accuracy = evaluate(net, data["dev_input"], data["dev_target"])
+	return dict(config, trial=trial_id, epochs=epochs, dev_loss=float(dev_loss), dev_accuracy=float(dev_accuracy))
+
+def sweep(
+	space, max_epochs, train_input, train_target, dev_input, dev_target,
+	num_trials=None, min_epochs=None, eta=3, hyperband=False,
+	num_workers=None, out_dir="sweep", results_path="sweep_results.csv", seed=0
+):
+	'''
+	Hyper-parameter sweep: trials run in parallel in a pool of num_workers
+	processes, all reading one read-only memory-mapped copy of the dataset
+	saved to out_dir. Every trial checkpoints to out_dir, so a trial given more
+	epochs resumes where it stopped. Trial checkpoints left in out_dir by an
+	earlier sweep are deleted first.
+
+	Without min_epochs every configuration is trained for max_epochs. With it,
+	successive halving is used: all configurations get min_epochs epochs, only
+	the best 1 / eta (by dev loss) continue with eta times as many, and so on
+	up to max_epochs. With hyperband, several such brackets are run, trading
+	the number of configurations against min_epochs.
+
+	Parameters
+	----------
+		space : search space, see SEARCH_SPACE and sample_configs
+		num_trials : number of random configurations (per bracket with
+					 hyperband), or None for the whole grid
+
+	Returns
+	----------
+		pandas DataFrame with one row per trial and rung: its configuration,
+		epochs trained, dev loss and accuracy, sorted by dev loss. It is also
+		written to results_path.
+	'''
+	os.makedirs(out_dir, exist_ok=True)
+	for name in os.listdir(out_dir):
+		if name.startswith("trial_") and (name.endswith(".npz") or name.endswith(".npz.tmp")):
+			os.remove(os.path.join(out_dir, name))
+	for name, array in (
+		("train_input", train_input), ("train_target", train_target),
+		("dev_input", dev_input), ("dev_target", dev_target),
+	):
+		np.save(os.path.join(out_dir, name + ".npy"), np.asarray(array))
+
+	if hyperband:
+		min_epochs = min_epochs or 1
+		s_max = int(np.floor(np.log(max_epochs / min_epochs) / np.log(eta) + 1e-9))
+		brackets = []
+		for s in range(s_max, -1, -1):
+			n = num_trials or int(np.ceil((s_max + 1) / (s + 1) * eta ** s))
+			brackets.append((sample_configs(space, n, seed + s), max_epochs / eta ** s))
+	else:
+		brackets = [(sample_configs(space, num_trials, seed), min_epochs or max_epochs)]
+
+	results = []
+	trial_id = 0
+	with multiprocessing.Pool(num_workers) as pool:
+		for configs, epochs in brackets:
+			trials = list(enumerate(configs, trial_id))
+			trial_id += len(configs)
+			epochs = max(1, int(round(epochs)))
+			while True:
+				rung = pool.map(_sweep_trial, [(i, config, epochs, out_dir, seed) for i, config in trials])
+				results.extend(rung)
+				_results_table(results).to_csv(results_path, index=False)
+				if epochs >= max_epochs or len(trials) <= 1:
+					break
+				# Keep the best 1 / eta of the trials and give them eta times the epochs
+				ranked = sorted(range(len(rung)), key=lambda i: rung[i]["dev_loss"])
+				trials = [trials[i] for i in ranked[:max(1, len(trials) // eta)]]
+				epochs = min(max_epochs, epochs * eta)
+
+	table = _results_table(results).sort_values("dev_loss")
+	table.to_csv(results_path, index=False)
+	return table
+
+def _results_table(results):
+	table = pd.DataFrame(results)
+	first = [c for c in ["trial", "epochs", "dev_loss", "dev_accuracy"] + list(TRIAL_KEYS) if c in table.columns]
+	return table[first + sorted(c for c in table.columns if c not in first)]
+
+def sweep_main():
+	train_input, train_target, dev_input, dev_target, test_input, preprocessor = read_data()
+	table = sweep(
+		SEARCH_SPACE, 300, train_input, train_target, dev_input, dev_target,
+		num_trials=27, min_epochs=10, eta=3
+	)
+	print(table.head(10))
+
 def main():
 
 	# Hyper-parameters 
@@ -663,17 +2863,36 @@ def main():
 	num_layers = 4
 	num_units = 100
 	lamda = 0.0  # Regularization Parameter
-
-	train_input, train_target, dev_input, dev_target, test_input = read_data()
-	net = Net(num_layers, num_units,4)
-	optimizer = Optimizer(learning_rate,"ADAM")
-	optimizer.SGD_ADAM(0.9,0.999, num_layers, num_units,4)
+	large_batch = False  # 4096-row batches with LAMB, sqrt-scaled learning rate and warmup
+	num_workers = 1  # Processes sharing each batch (data-parallel), worth it for large batches
+	resume = False  # Continue from checkpoint.npz, saved by an earlier run of the same configuration
+
+	# Input columns: None for all of them, read_feature_list() for those of features.csv
+	features = None
+
+	train_input, train_target, dev_input, dev_target, test_input, preprocessor = read_data(features)
+	# The first layer (and so the optimizer state) is sized from the selected features
+	net = Net(num_layers, num_units,4, num_feats=preprocessor.num_outputs)
+	if large_batch:
+		optimizer = large_batch_optimizer(
+			"LAMB", learning_rate, 4096, train_input.shape[0],
+			base_batch_size=batch_size, beta1=0.9, beta2=0.999
+		)
+		batch_size = 4096
+	else:
+		optimizer = make_optimizer("ADAM", learning_rate, beta1=0.9, beta2=0.999)
+	scheduler = make_scheduler("cosine", optimizer, total_steps=max_epochs)
+	early_stopping = EarlyStopping(patience=10, every=1)
 	train(
 		net, optimizer, lamda, batch_size, max_epochs,
 		train_input, train_target,
-		dev_input, dev_target
+		dev_input, dev_target, scheduler, early_stopping,
+		checkpoint_path="checkpoint.npz", num_workers=num_workers, preprocessor=preprocessor,
+		resume=resume
 	)
-	get_test_data_predictions(net, test_input)
+	# The saved model has the preprocessing folded in and takes raw feature rows
+	net.fold(preprocessor).save("model.npy")
+	get_test_data_predictions(net.fold(), test_input)
 
 
 
@@ -716,7 +2935,10 @@ def main():
 
 
 if __name__ == '__main__':
-	main()
+	if len(sys.argv) > 1 and sys.argv[1] == "sweep":
+		sweep_main()
+	else:
+		main()
 	# array = np.array([[1,2,3],[2,8,6]])
 	# std = np.mean(array,axis = 0)
 	# print(std)
@@ -1,5 +1,6 @@
 import sys
 import os
+import json
 import numpy as np
 import pandas as pd
 from scipy import stats
@@ -463,17 +464,97 @@ def get_test_data_predictions(net, inputs):
 	return pred
 
 
+CACHE_DIR = '.npy_cache'
+# Bump when the layout of the cached arrays changes, to rebuild old caches
+CACHE_VERSION = 1
+
+def _cache_dir(path):
+	return os.path.join(os.path.dirname(path), CACHE_DIR, os.path.basename(path))
+
+def _source_key(path):
+	stat = os.stat(path)
+	return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def ingest_csv(path, has_target=True):
+	'''
+	Parse a csv file once and store it as contiguous .npy arrays, together with
+	a manifest recording the size and mtime of the csv it was built from.
+
+	Parameters
+	----------
+		path : path of the csv file
+		has_target : True if the first column of the csv is the target
+
+	Returns
+	----------
+		manifest : dict describing the cached arrays
+	'''
+	cache_dir = _cache_dir(path)
+	manifest_path = os.path.join(cache_dir, 'manifest.json')
+	os.makedirs(cache_dir, exist_ok=True)
+	if os.path.exists(manifest_path):
+		os.remove(manifest_path)
+
+	source = _source_key(path)
+	df = pd.read_csv(path)
+	if has_target:
+		target = df.iloc[:, 0].to_numpy()
+		if target.dtype == object:
+			target = target.astype(str)
+		np.save(os.path.join(cache_dir, 'target.npy'), target)
+		df = df.iloc[:, 1:]
+	inputs = np.ascontiguousarray(df.to_numpy(dtype='float64'))
+	np.save(os.path.join(cache_dir, 'inputs.npy'), inputs)
+
+	manifest = {"version": CACHE_VERSION, "source": source, "has_target": has_target, "columns": [str(c) for c in df.columns]}
+	with open(manifest_path + '.tmp', 'w') as f:
+		json.dump(manifest, f)
+	os.replace(manifest_path + '.tmp', manifest_path)
+	return manifest
+
+def load_csv(path, has_target=True):
+	'''
+	Load a csv file through the binary cache. The csv is only parsed when the
+	cache is missing, was written in an older CACHE_VERSION or the csv changed
+	since it was ingested.
+
+	Parameters
+	----------
+		path : path of the csv file
+		has_target : True if the first column of the csv is the target
+
+	Returns
+	----------
+		inputs : read-only memory-mapped float64 array of shape m x d
+		target : read-only memory-mapped array of shape m, None if has_target is False
+	'''
+	cache_dir = _cache_dir(path)
+	manifest_path = os.path.join(cache_dir, 'manifest.json')
+	manifest = None
+	if os.path.exists(manifest_path):
+		with open(manifest_path) as f:
+			manifest = json.load(f)
+	if manifest is None or manifest.get("version") != CACHE_VERSION or manifest["source"] != _source_key(path) \
+			or manifest["has_target"] != has_target:
+		manifest = ingest_csv(path, has_target)
+
+	inputs = np.load(os.path.join(cache_dir, 'inputs.npy'), mmap_mode='r')
+	target = None
+	if has_target:
+		target = np.load(os.path.join(cache_dir, 'target.npy'), mmap_mode='r')
+	return inputs, target
+
 X_mean = None
 X_std = None
 def normalize(X, train):
 	global X_mean, X_std
 
 	if train == True:
-		X_mean = X.mean()
-		X_std = X.std()
+		X_mean = X.mean(axis=0)
+		X_std = X.std(axis=0, ddof=1)
 		# X = X[(np.abs(stats.zscore(X)) < 2).all(axis=1)]
 		print(X.shape)
-		return (X-X.mean())/(X.std())# + 0.00000001)
+		return (X-X_mean)/(X_std)# + 0.00000001)
 	else:
 		return (X-X_mean)/(X_std)
 
@@ -481,17 +562,15 @@ def read_data():
 	'''
 	Read the train, dev, and test datasets
 	'''
-	df_train = pd.read_csv('22m0754/regression/data/train.csv')
-	df_dev = pd.read_csv('22m0754/regression/data/dev.csv')
-	test_input = pd.read_csv('22m0754/regression/data/test.csv')  # .to_numpy()
+	train_input, train_target = load_csv('22m0754/regression/data/train.csv')
+	dev_input, dev_target = load_csv('22m0754/regression/data/dev.csv')
+	test_input, _ = load_csv('22m0754/regression/data/test.csv', False)
 
-	train_input = normalize(df_train.iloc[:, 1:], True).to_numpy()
+	train_input = normalize(train_input, True)
 
-	test_input = normalize(test_input,False).to_numpy()
-	train_target = (df_train.iloc[:, 0]).to_numpy()
+	test_input = normalize(test_input, False)
 	train_target = train_target.reshape(train_target.shape[0], 1)
-	dev_input = normalize(df_dev.iloc[:, 1:], False).to_numpy()
-	dev_target = (df_dev.iloc[:, 0]).to_numpy()
+	dev_input = normalize(dev_input, False)
 	dev_target = dev_target.reshape(dev_target.shape[0], 1)
 	return train_input, train_target, dev_input, dev_target, test_input
 
@@ -501,17 +580,12 @@ def read_data_non_normalize():
 	'''
 	Read the train, dev, and test datasets
 	'''
-	df_train = pd.read_csv('22m0754/regression/data/train.csv')
-	df_dev = pd.read_csv('22m0754/regression/data/dev.csv')
-	test_input = pd.read_csv('22m0754/regression/data/test.csv')  # .to_numpy()
+	train_input, train_target = load_csv('22m0754/regression/data/train.csv')
+	dev_input, dev_target = load_csv('22m0754/regression/data/dev.csv')
+	test_input, _ = load_csv('22m0754/regression/data/test.csv', False)
 	
-	test_input = (test_input).to_numpy()
 
-	train_input = (df_train.iloc[:, 1:]).to_numpy()
-	train_target = df_train.iloc[:, 0].to_numpy()
 	train_target = train_target.reshape(train_target.shape[0], 1)
-	dev_input = (df_dev.iloc[:, 1:]).to_numpy()
-	dev_target = df_dev.iloc[:, 0].to_numpy()
 	dev_target = dev_target.reshape(dev_target.shape[0], 1)
 	return train_input, train_target, dev_input, dev_target, test_input
 
@@ -1,5 +1,6 @@
 import sys
 import os
+import json
 import numpy as np
 import pandas as pd
 from scipy import stats
@@ -15,7 +16,7 @@ class Net(object):
 	'''
 	'''
 
-	def __init__(self, num_layers, num_units):
+	def __init__(self, num_layers, num_units, momentum=0.1):
 		'''
 		Initialize the neural network.
 		Create weights and biases.
@@ -36,9 +37,13 @@ class Net(object):
 		----------
 			num_layers : Number of HIDDEN layers.
 			num_units : Number of units in each Hidden layer.
+			momentum : Weight of the current batch in the moving averages of the
+					   normalization statistics.
 		'''
 		self.num_layers = num_layers
 		self.num_units = num_units
+		self.momentum = momentum
+		self.mode = "train"
 
 		self.betas = []
 		self.gammas = []
@@ -60,6 +65,10 @@ class Net(object):
 		self.gammas.append(np.random.uniform(-1, 1, size=(1, 1)))
 		self.betas.append(np.random.uniform(-1, 1, size=(1, 1)))
 		self.weights.append(np.random.uniform(-1, 1, size=(self.num_units, 1)))
+
+		# Moving averages of the per-layer batch mean and std, used in "eval" mode
+		self.running_means = [np.zeros((1, self.num_units)) for i in range(num_layers)]
+		self.running_stds = [np.ones((1, self.num_units)) for i in range(num_layers)]
 		# print(self.biases)
 		# print(self.weights)
 		'''
@@ -80,6 +89,56 @@ class Net(object):
 		self.betas.append(np.sqrt(2/self.num_units) * np.random.randn(1, 1))
 		self.weights.append(np.sqrt(2/self.num_units) * np.random.randn(self.num_units, 1))
 	'''
+	def set_mode(self, mode):
+		'''
+		Switch between "train" mode, where hidden layers are normalized with the
+		statistics of the current batch and the moving averages are updated, and
+		"eval" mode, where the moving averages are used instead. In eval mode the
+		output for a row does not depend on the other rows of the batch, so single
+		rows can be scored.
+		'''
+		if mode not in ("train", "eval"):
+			raise ValueError("mode must be 'train' or 'eval', got {}".format(mode))
+		self.mode = mode
+
+	def update_running_stats(self, index, mean, std):
+		'''
+		Fold the statistics of the current batch into the moving averages of layer index.
+		'''
+		self.running_means[index] = (1 - self.momentum) * self.running_means[index] + self.momentum * mean
+		self.running_stds[index] = (1 - self.momentum) * self.running_stds[index] + self.momentum * std
+
+	def recompute_running_stats(self, X, batch_size):
+		'''
+		Replace the moving averages by the average batch statistics over one pass of
+		X in batches of batch_size, with the weights frozen. While the weights change
+		quickly the moving averages lag behind them; this removes the lag once
+		training is done.
+		'''
+		means = [np.zeros_like(r) for r in self.running_means]
+		stds = [np.zeros_like(r) for r in self.running_stds]
+		count = 0
+		for start in range(0, X.shape[0], batch_size):
+			a = X[start:start+batch_size]
+			for i in range(self.num_layers):
+				h = np.dot(a, self.weights[i])
+				mean = h.mean(axis=0, keepdims=True)
+				std = h.std(axis=0, keepdims=True)
+				means[i] = means[i] + mean
+				stds[i] = stds[i] + std
+				a = relu(((h - mean)/(std + 0.00000001)) * self.gammas[i].T + self.betas[i].T)
+			count += 1
+		self.running_means = [mean / count for mean in means]
+		self.running_stds = [std / count for std in stds]
+
+	def fold(self):
+		'''
+		Export the network for inference, with the normalization of every hidden
+		layer folded into its weights (see FoldedNet). The moving averages of the
+		normalization statistics are used, as in "eval" mode.
+		'''
+		return FoldedNet(self)
+
 	def __call__(self, X):
 		'''
 		Forward propagate the input X through the network,
@@ -108,12 +167,22 @@ class Net(object):
 			self.a_states.append(a)
 
 			h = np.dot(a, w)
-			# print("h.shape",h.shape)
-			mean_m = np.mean(h,axis=0)
-			# print("mean_m.shape", mean_m.shape)
-			mean_m = mean_m.reshape(1,mean_m.shape[0])
-			std_m = np.std(h, axis=0)
-			std_m = std_m.reshape(1, std_m.shape[0]) + 0.00000001
+			if i == len(self.weights) - 1:
+				# The output layer is not normalized
+				mean_m = 0
+				std_m = 1
+			elif self.mode == "eval":
+				mean_m = self.running_means[i]
+				std_m = self.running_stds[i] + 0.00000001
+			else:
+				# print("h.shape",h.shape)
+				mean_m = np.mean(h,axis=0)
+				# print("mean_m.shape", mean_m.shape)
+				mean_m = mean_m.reshape(1,mean_m.shape[0])
+				std_m = np.std(h, axis=0)
+				std_m = std_m.reshape(1, std_m.shape[0])
+				self.update_running_stats(i, mean_m, std_m)
+				std_m = std_m + 0.00000001
 
 			b = ((h - mean_m)/std_m)
 			self.std_states.append(std_m)
@@ -184,6 +253,54 @@ class Net(object):
 		# update_gradient = 1./batch_size * np.sum(loss_gradient, axis=0) # num_units
 
 
+class FoldedNet(object):
+	'''
+	Inference-only version of a trained Net, made of plain matmul + bias + relu layers.
+
+	A hidden layer of Net computes relu(((a @ w - mean) / std) * gamma + beta) with
+	frozen statistics, which is the same as relu(a @ (w * scale) + (beta - mean * scale))
+	with scale = gamma / std. Folding scale into the weights and the rest into a bias
+	removes three full passes over the activations per layer.
+	'''
+
+	def __init__(self, net):
+		'''
+		Parameters
+		----------
+			net : trained Net
+		'''
+		self.weights = []
+		self.biases = []
+		for i, w in enumerate(net.weights):
+			if i < net.num_layers:
+				scale = net.gammas[i].T / (net.running_stds[i] + 0.00000001)
+				self.weights.append(w * scale)
+				self.biases.append(net.betas[i].T - net.running_means[i] * scale)
+			else:  # The output layer is not normalized
+				self.weights.append(w.copy())
+				self.biases.append(np.zeros((1, w.shape[1])))
+
+	def __call__(self, X):
+		'''
+		Forward propagate the input X through the folded network.
+
+		Parameters
+		----------
+			X : Input to the network, numpy array of shape m x d
+		Returns
+		----------
+			y : Output of the network, numpy array of shape m x 1
+		'''
+		a = X
+		for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+			h = np.dot(a, w)
+			h += b
+			if i < len(self.weights) - 1:
+				np.maximum(h, 0, out=h)
+			a = h
+		return a
+
+
 def relu(X):
 	a = np.maximum(X,0)
 	return a
@@ -444,6 +561,7 @@ def train(
 	m = train_input.shape[0]
 
 	for e in range(max_epochs):
+		net.set_mode("train")
 		epoch_loss = 0
 		train = np.hstack((train_input, train_target))
 		np.random.shuffle(train)
@@ -495,6 +613,8 @@ def train(
 	# After running `max_epochs` (for Part 1) epochs OR early stopping (for Part 2), compute the RMSE on dev data.
 
 	# '''
+	net.recompute_running_stats(train_input, batch_size)
+	net.set_mode("eval")
 	dev_pred = net(dev_input)
 	# pd.DataFrame(np.concatenate((dev_pred, dev_target), axis=1)).to_csv("dev_test.csv")
 	train_pred = net(train_input)
@@ -523,7 +643,7 @@ def get_test_data_predictions(net, inputs):
 
 	Parameters
 	----------
-		net : trained neural network
+		net : trained neural network (a Net or the FoldedNet from net.fold())
 		inputs : test input, numpy array of shape m x d
 
 	Returns
@@ -535,17 +655,97 @@ def get_test_data_predictions(net, inputs):
 	return pred
 
 
+CACHE_DIR = '.npy_cache'
+# Bump when the layout of the cached arrays changes, to rebuild old caches
+CACHE_VERSION = 1
+
+def _cache_dir(path):
+	return os.path.join(os.path.dirname(path), CACHE_DIR, os.path.basename(path))
+
+def _source_key(path):
+	stat = os.stat(path)
+	return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def ingest_csv(path, has_target=True):
+	'''
+	Parse a csv file once and store it as contiguous .npy arrays, together with
+	a manifest recording the size and mtime of the csv it was built from.
+
+	Parameters
+	----------
+		path : path of the csv file
+		has_target : True if the first column of the csv is the target
+
+	Returns
+	----------
+		manifest : dict describing the cached arrays
+	'''
+	cache_dir = _cache_dir(path)
+	manifest_path = os.path.join(cache_dir, 'manifest.json')
+	os.makedirs(cache_dir, exist_ok=True)
+	if os.path.exists(manifest_path):
+		os.remove(manifest_path)
+
+	source = _source_key(path)
+	df = pd.read_csv(path)
+	if has_target:
+		target = df.iloc[:, 0].to_numpy()
+		if target.dtype == object:
+			target = target.astype(str)
+		np.save(os.path.join(cache_dir, 'target.npy'), target)
+		df = df.iloc[:, 1:]
+	inputs = np.ascontiguousarray(df.to_numpy(dtype='float64'))
+	np.save(os.path.join(cache_dir, 'inputs.npy'), inputs)
+
+	manifest = {"version": CACHE_VERSION, "source": source, "has_target": has_target, "columns": [str(c) for c in df.columns]}
+	with open(manifest_path + '.tmp', 'w') as f:
+		json.dump(manifest, f)
+	os.replace(manifest_path + '.tmp', manifest_path)
+	return manifest
+
+def load_csv(path, has_target=True):
+	'''
+	Load a csv file through the binary cache. The csv is only parsed when the
+	cache is missing, was written in an older CACHE_VERSION or the csv changed
+	since it was ingested.
+
+	Parameters
+	----------
+		path : path of the csv file
+		has_target : True if the first column of the csv is the target
+
+	Returns
+	----------
+		inputs : read-only memory-mapped float64 array of shape m x d
+		target : read-only memory-mapped array of shape m, None if has_target is False
+	'''
+	cache_dir = _cache_dir(path)
+	manifest_path = os.path.join(cache_dir, 'manifest.json')
+	manifest = None
+	if os.path.exists(manifest_path):
+		with open(manifest_path) as f:
+			manifest = json.load(f)
+	if manifest is None or manifest.get("version") != CACHE_VERSION or manifest["source"] != _source_key(path) \
+			or manifest["has_target"] != has_target:
+		manifest = ingest_csv(path, has_target)
+
+	inputs = np.load(os.path.join(cache_dir, 'inputs.npy'), mmap_mode='r')
+	target = None
+	if has_target:
+		target = np.load(os.path.join(cache_dir, 'target.npy'), mmap_mode='r')
+	return inputs, target
+
 X_mean = None
 X_std = None
 def normalize(X, train):
 	global X_mean, X_std
 
 	if train == True:
-		X_mean = X.mean()
-		X_std = X.std()
+		X_mean = X.mean(axis=0)
+		X_std = X.std(axis=0, ddof=1)
 		# X = X[(np.abs(stats.zscore(X)) < 2).all(axis=1)]
 		print(X.shape)
-		return (X-X.mean())/(X.std())# + 0.00000001)
+		return (X-X_mean)/(X_std)# + 0.00000001)
 	else:
 		return (X-X_mean)/(X_std)
 
@@ -553,21 +753,19 @@ def read_data():
 	'''
 	Read the train, dev, and test datasets
 	'''
-	df_train = pd.read_csv('22m0754/regression/data/train.csv')
-	df_dev = pd.read_csv('22m0754/regression/data/dev.csv')
-	test_input = pd.read_csv('22m0754/regression/data/test.csv')  # .to_numpy()
+	train_input, train_target = load_csv('22m0754/regression/data/train.csv')
+	dev_input, dev_target = load_csv('22m0754/regression/data/dev.csv')
+	test_input, _ = load_csv('22m0754/regression/data/test.csv', False)
 
-	train_input = normalize(df_train.iloc[:, 1:], True).to_numpy()
+	train_input = normalize(train_input, True)
 	# train_input = pca.fit_transform(train_input)
 
-	test_input = normalize(test_input,False).to_numpy()
+	test_input = normalize(test_input, False)
 
-	train_target = (df_train.iloc[:, 0]).to_numpy()
 	train_target = train_target.reshape(train_target.shape[0], 1)
 	# train_target = min_max_scaling(train_target)
-	dev_input = normalize(df_dev.iloc[:, 1:], False).to_numpy()
+	dev_input = normalize(dev_input, False)
 	# dev_input = pca.transform(dev_input)
-	dev_target = (df_dev.iloc[:, 0]).to_numpy()
 	dev_target = dev_target.reshape(dev_target.shape[0], 1)
 	# dev_target = min_max_scaling(dev_target)
 	return train_input, train_target, dev_input, dev_target, test_input
@@ -578,16 +776,11 @@ def read_data_non_normalize():
 	'''
 	Read the train, dev, and test datasets
 	'''
-	df_train = pd.read_csv('22m0754/regression/data/train.csv')
-	df_dev = pd.read_csv('22m0754/regression/data/dev.csv')
-	test_input = pd.read_csv('22m0754/regression/data/test.csv')  # .to_numpy()
-	test_input = (test_input).to_numpy()
+	train_input, train_target = load_csv('22m0754/regression/data/train.csv')
+	dev_input, dev_target = load_csv('22m0754/regression/data/dev.csv')
+	test_input, _ = load_csv('22m0754/regression/data/test.csv', False)
 
-	train_input = (df_train.iloc[:, 1:]).to_numpy()
-	train_target = df_train.iloc[:, 0].to_numpy()
 	train_target = train_target.reshape(train_target.shape[0], 1)
-	dev_input = (df_dev.iloc[:, 1:]).to_numpy()
-	dev_target = df_dev.iloc[:, 0].to_numpy()
 	dev_target = dev_target.reshape(dev_target.shape[0], 1)
 	return train_input, train_target, dev_input, dev_target, test_input
 
@@ -613,7 +806,7 @@ def main():
 		train_input, train_target,
 		dev_input, dev_target
 	)
-	get_test_data_predictions(net, test_input)
+	get_test_data_predictions(net.fold(), test_input)
 
 
 
@@ -1,5 +1,6 @@
 import sys
 import os
+import json
 import numpy as np
 import pandas as pd
 from scipy import stats
@@ -9,19 +10,18 @@ import matplotlib.pyplot as plt
 # The seed will be fixed to 42 for this assigmnet.
 np.random.seed(42)
 
-n_components = 89
+# Number of PCA components, or (below 1) the explained variance ratio they must reach
+n_components = 0.95
 is_pca = "Y"
+pca_method = "exact"  # "exact", "randomized" or "incremental", see fit_pca
 
-if is_pca == "Y":
-  NUM_FEATS = n_components
-else:
-  NUM_FEATS = 90
+NUM_FEATS = 90
 
 class Net(object):
   '''
   '''
 
-  def __init__(self, num_layers, num_units):
+  def __init__(self, num_layers, num_units, num_feats=NUM_FEATS):
     '''
     Initialize the neural network.
     Create weights and biases.
@@ -43,9 +43,11 @@ class Net(object):
     ----------
       num_layers : Number of HIDDEN layers.
       num_units : Number of units in each Hidden layer.
+      num_feats : Number of input features (e.g. the number of PCA components).
     '''
     self.num_layers = num_layers
     self.num_units = num_units
+    self.num_feats = num_feats
 
     self.betas = []
     self.gammas = []
@@ -56,7 +58,7 @@ class Net(object):
       if i == 0:
         # Input layer
         self.weights.append(
-            np.random.uniform(-1, 1, size=(NUM_FEATS, self.num_units)))
+            np.random.uniform(-1, 1, size=(self.num_feats, self.num_units)))
       else:
         # Hidden layer
         self.weights.append(
@@ -240,7 +242,7 @@ class Optimizer(object):
     self.learning_rate = learning_rate
     self.optimizer_type = optimizer_type
 
-  def SGD_MR(self, beta, num_layers, num_units):
+  def SGD_MR(self, beta, num_layers, num_units, num_feats=NUM_FEATS):
     self.beta = beta
     self.Vt = []
     self.Bt = []
@@ -249,7 +251,7 @@ class Optimizer(object):
 
       if i == 0:
         # Input layer
-        self.Vt.append(np.zeros(((NUM_FEATS, num_units))))
+        self.Vt.append(np.zeros(((num_feats, num_units))))
       else:
         # Hidden layer
         self.Vt.append(np.zeros((num_units, num_units)))
@@ -262,7 +264,7 @@ class Optimizer(object):
     self.Gt.append(np.zeros((1, 1)))
     self.Vt.append(np.zeros((num_units, 1)))
 
-  def SGD_ADAM(self, beta1, beta2, num_layers, num_units):
+  def SGD_ADAM(self, beta1, beta2, num_layers, num_units, num_feats=NUM_FEATS):
     self.beta1 = beta1
     self.beta2 = beta2
     self.Vt = []
@@ -275,8 +277,8 @@ class Optimizer(object):
 
       if i == 0:
         # Input layer
-        self.Vt.append(np.zeros(((NUM_FEATS, num_units))))
-        self.Vt2.append(np.zeros(((NUM_FEATS, num_units))))
+        self.Vt.append(np.zeros(((num_feats, num_units))))
+        self.Vt2.append(np.zeros(((num_feats, num_units))))
 
       else:
         # Hidden layer
@@ -578,6 +580,91 @@ def get_test_data_predictions(net, inputs):
   return pred
 
 
+CACHE_DIR = '.npy_cache'
+# Bump when the layout of the cached arrays changes, to rebuild old caches
+CACHE_VERSION = 1
+
+
+def _cache_dir(path):
+  return os.path.join(os.path.dirname(path), CACHE_DIR, os.path.basename(path))
+
+
+def _source_key(path):
+  stat = os.stat(path)
+  return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def ingest_csv(path, has_target=True):
+  '''
+  Parse a csv file once and store it as contiguous .npy arrays, together with
+  a manifest recording the size and mtime of the csv it was built from.
+
+  Parameters
+  ----------
+    path : path of the csv file
+    has_target : True if the first column of the csv is the target
+
+  Returns
+  ----------
+    manifest : dict describing the cached arrays
+  '''
+  cache_dir = _cache_dir(path)
+  manifest_path = os.path.join(cache_dir, 'manifest.json')
+  os.makedirs(cache_dir, exist_ok=True)
+  if os.path.exists(manifest_path):
+    os.remove(manifest_path)
+
+  source = _source_key(path)
+  df = pd.read_csv(path)
+  if has_target:
+    target = df.iloc[:, 0].to_numpy()
+    if target.dtype == object:
+      target = target.astype(str)
+    np.save(os.path.join(cache_dir, 'target.npy'), target)
+    df = df.iloc[:, 1:]
+  inputs = np.ascontiguousarray(df.to_numpy(dtype='float64'))
+  np.save(os.path.join(cache_dir, 'inputs.npy'), inputs)
+
+  manifest = {"version": CACHE_VERSION, "source": source, "has_target": has_target, "columns": [str(c) for c in df.columns]}
+  with open(manifest_path + '.tmp', 'w') as f:
+    json.dump(manifest, f)
+  os.replace(manifest_path + '.tmp', manifest_path)
+  return manifest
+
+
+def load_csv(path, has_target=True):
+  '''
+  Load a csv file through the binary cache. The csv is only parsed when the
+  cache is missing, was written in an older CACHE_VERSION or the csv changed
+  since it was ingested.
+
+  Parameters
+  ----------
+    path : path of the csv file
+    has_target : True if the first column of the csv is the target
+
+  Returns
+  ----------
+    inputs : read-only memory-mapped float64 array of shape m x d
+    target : read-only memory-mapped array of shape m, None if has_target is False
+  '''
+  cache_dir = _cache_dir(path)
+  manifest_path = os.path.join(cache_dir, 'manifest.json')
+  manifest = None
+  if os.path.exists(manifest_path):
+    with open(manifest_path) as f:
+      manifest = json.load(f)
+  if manifest is None or manifest.get("version") != CACHE_VERSION or manifest["source"] != _source_key(path) \
+      or manifest["has_target"] != has_target:
+    manifest = ingest_csv(path, has_target)
+
+  inputs = np.load(os.path.join(cache_dir, 'inputs.npy'), mmap_mode='r')
+  target = None
+  if has_target:
+    target = np.load(os.path.join(cache_dir, 'target.npy'), mmap_mode='r')
+  return inputs, target
+
+
 X_mean = None
 X_std = None
 
@@ -586,66 +673,283 @@ def normalize(X, train):
   global X_mean, X_std
 
   if train == True:
-    X_mean = X.mean()
-    X_std = X.std()
+    X_mean = X.mean(axis=0)
+    X_std = X.std(axis=0, ddof=1)
     # X = X[(np.abs(stats.zscore(X)) < 2).all(axis=1)]
     print(X.shape)
-    return (X-X.mean())/(X.std())  # + 0.00000001)
+    return (X-X_mean)/(X_std)  # + 0.00000001)
   else:
     return (X-X_mean)/(X_std)
 
 
-def scratch_pca(matrix, n_components, set, u):
-  mean_matrix = matrix - np.mean(matrix, axis=0)
-  covar = np.cov(mean_matrix, rowvar=False)
-  ret = np.linalg.eigh(covar)
-  eig_val = ret[0]
-  eig_vec = ret[1]
+PCA_CHUNK_ROWS = 65536
 
-  U = []
 
-  if set == "train":
-    for i in sorted(eig_val, reverse=True)[:n_components]:
-      ind = list(eig_val).index(i)
-      U.append(eig_vec[ind])
+def _chunks(X, chunk_size):
+  for start in range(0, X.shape[0], chunk_size):
+    yield np.array(X[start:start + chunk_size], dtype='float64')
 
-  else:
-    Z = np.transpose(np.dot(u, np.transpose(matrix)))
-    return Z, u
 
-  Z = np.transpose(np.dot(U, np.transpose(matrix)))
-  x_app = np.transpose(np.dot(np.transpose(U), np.transpose(Z)))
-  var = np.square(matrix - x_app) / np.square(matrix)
+def _column_mean(X, chunk_size):
+  total = np.zeros(X.shape[1])
+  for chunk in _chunks(X, chunk_size):
+    total += chunk.sum(axis=0)
+  return total / X.shape[0]
+
+
+class PCABasis(object):
+  '''
+  A fitted PCA basis: the mean of the training data and the top principal
+  directions, reusable to transform dev and test data.
+
+  Attributes
+  ----------
+    mean : column means of the training data, shape d
+    components : principal directions as rows, shape k x d, by decreasing variance
+    explained_variance : variance along every component, shape k
+    total_variance : total variance of the training data (sum over all d columns)
+  '''
+
+  def __init__(self, mean, components, explained_variance, total_variance):
+    self.mean = mean
+    self.components = components
+    self.explained_variance = explained_variance
+    self.total_variance = total_variance
+
+  @property
+  def n_components(self):
+    return self.components.shape[0]
+
+  @property
+  def explained_variance_ratio(self):
+    return self.explained_variance / self.total_variance
+
+  def truncate(self, k):
+    '''
+    The basis made of the first k components.
+    '''
+    return PCABasis(self.mean, self.components[:k], self.explained_variance[:k], self.total_variance)
+
+  def transform(self, X, chunk_size=PCA_CHUNK_ROWS):
+    '''
+    Project X (numpy or memory-mapped, m x d) on the basis, chunk_size rows at
+    a time. Returns the m x k projections.
+    '''
+    Z = np.empty((X.shape[0], self.n_components))
+    for start in range(0, X.shape[0], chunk_size):
+      chunk = np.asarray(X[start:start + chunk_size], dtype='float64') - self.mean
+      np.dot(chunk, self.components.T, out=Z[start:start + chunk.shape[0]])
+    return Z
+
+  def inverse_transform(self, Z):
+    return np.dot(Z, self.components) + self.mean
+
+  def reconstruction_error(self, X, chunk_size=PCA_CHUNK_ROWS):
+    '''
+    Mean squared error of reconstructing X from its projections. Only computed
+    on request; fitting and transforming never need it.
+    '''
+    total = 0.0
+    for chunk in _chunks(X, chunk_size):
+      total += np.square(chunk - self.inverse_transform(self.transform(chunk))).sum()
+    return total / X.size
+
+
+def _top_eigh(matrix, n_components):
+  '''
+  Top n_components eigenvalues (decreasing) and eigenvectors (as rows) of a
+  symmetric matrix.
+  '''
+  eig_val, eig_vec = np.linalg.eigh(matrix)
+  order = np.argsort(eig_val)[::-1][:n_components]
+  return eig_val[order], eig_vec[:, order].T
+
+
+def fit_pca_exact(X, n_components, chunk_size=PCA_CHUNK_ROWS):
+  '''
+  PCA from the eigendecomposition of the covariance matrix, which is
+  accumulated chunk by chunk (X may be a memory-mapped array larger than RAM).
+  '''
+  m, d = X.shape
+  mean = _column_mean(X, chunk_size)
+  covar = np.zeros((d, d))
+  for chunk in _chunks(X, chunk_size):
+    chunk -= mean
+    covar += np.dot(chunk.T, chunk)
+  covar /= m - 1
+  eig_val, components = _top_eigh(covar, n_components)
+  return PCABasis(mean, components, eig_val, np.trace(covar))
+
+
+def fit_pca_randomized(X, n_components, n_oversamples=10, n_iter=4, chunk_size=PCA_CHUNK_ROWS, seed=0):
+  '''
+  Randomized PCA: subspace iteration on the covariance from a random start
+  of n_components + n_oversamples directions. The covariance is never formed;
+  every pass over X (chunk by chunk) multiplies it with the d x l subspace,
+  which costs O(m d l) instead of the O(m d^2) of the exact method.
+  '''
+  m, d = X.shape
+  l = min(d, n_components + n_oversamples)
+  mean = _column_mean(X, chunk_size)
+  rng = np.random.RandomState(seed)
+  Q = np.linalg.qr(rng.normal(size=(d, l)))[0]
+  total_variance = 0.0
+  for it in range(n_iter + 1):
+    # CQ = X_c^T (X_c Q) / (m - 1), summed over chunks
+    CQ = np.zeros((d, l))
+    for chunk in _chunks(X, chunk_size):
+      chunk -= mean
+      CQ += np.dot(chunk.T, np.dot(chunk, Q))
+      if it == 0:
+        total_variance += np.square(chunk).sum()
+    CQ /= m - 1
+    if it < n_iter:
+      Q = np.linalg.qr(CQ)[0]
+  # Rayleigh-Ritz: eigendecomposition of Q^T C Q in the final subspace
+  eig_val, small_vec = _top_eigh(np.dot(Q.T, CQ), n_components)
+  return PCABasis(mean, np.dot(small_vec, Q.T), eig_val, total_variance / (m - 1))
+
+
+class IncrementalPCA(object):
+  '''
+  Streaming PCA, fitted one chunk at a time with partial_fit, so the data
+  never has to be in memory at once. The components are kept as a truncated
+  SVD of the data seen so far, updated with every chunk.
+  '''
+
+  def __init__(self, n_components):
+    self.n_components = n_components
+    self.n_samples = 0
+    self.mean = None
+    self.sum_sq = None  # Sum of squared deviations from the mean, per column
+    self.singular_values = None
+    self.components = None
+
+  def partial_fit(self, chunk):
+    chunk = np.asarray(chunk, dtype='float64')
+    n, m = self.n_samples, chunk.shape[0]
+    chunk_mean = chunk.mean(axis=0)
+    centered = chunk - chunk_mean
+    chunk_sum_sq = np.square(centered).sum(axis=0)
+    if n == 0:
+      self.mean = chunk_mean
+      self.sum_sq = chunk_sum_sq
+      stacked = centered
+    else:
+      delta = chunk_mean - self.mean
+      # The chunk's offset from the old mean, as one extra row of the data
+      correction = np.sqrt(n * m / (n + m)) * delta
+      stacked = np.vstack((self.singular_values[:, None] * self.components, centered, correction))
+      self.sum_sq = self.sum_sq + chunk_sum_sq + np.square(delta) * n * m / (n + m)
+      self.mean = self.mean + delta * m / (n + m)
+    U, S, Vt = np.linalg.svd(stacked, full_matrices=False)
+    self.singular_values = S[:self.n_components]
+    self.components = Vt[:self.n_components]
+    self.n_samples = n + m
+    return self
+
+  def basis(self):
+    '''
+    The PCABasis fitted on the chunks seen so far.
+    '''
+    dof = self.n_samples - 1
+    return PCABasis(self.mean, self.components, np.square(self.singular_values) / dof, self.sum_sq.sum() / dof)
+
+
+def fit_pca_incremental(X, n_components, chunk_size=PCA_CHUNK_ROWS):
+  '''
+  PCA fitted with IncrementalPCA, one chunk of chunk_size rows at a time.
+  '''
+  pca = IncrementalPCA(n_components)
+  for chunk in _chunks(X, max(chunk_size, n_components)):
+    pca.partial_fit(chunk)
+  return pca.basis()
+
+
+PCA_METHODS = {
+  "exact": fit_pca_exact,
+  "randomized": fit_pca_randomized,
+  "incremental": fit_pca_incremental,
+}
+
+# Components first fitted by the approximate methods when looking for an
+# explained variance ratio; doubled until the ratio is reached
+PCA_RATIO_START = 8
+
 
-  return Z, U
+def select_n_components(basis, target):
+  '''
+  Smallest number of components of basis whose explained variance ratio
+  reaches target.
+  '''
+  curve = np.cumsum(basis.explained_variance_ratio)
+  k = int(np.searchsorted(curve, target * (1 - 1e-12))) + 1
+  return min(k, basis.n_components)
+
+
+def fit_pca(X, n_components, method="exact", **kwargs):
+  '''
+  Fit a PCABasis on X (m x d, numpy or memory-mapped).
+
+  Parameters
+  ----------
+    n_components : number of components, or, if between 0 and 1, the explained
+                   variance ratio to reach: the smallest such number of
+                   components is kept, and the explained variance curve printed
+    method : "exact" (eigendecomposition of the covariance), "randomized"
+             (subspace iteration, for large d) or "incremental" (streaming SVD)
+
+  For a ratio, the exact method gets all d eigenvalues from its one
+  eigendecomposition. The other methods are refitted with PCA_RATIO_START,
+  then twice as many, ... components until those reach the ratio of the
+  total variance (the trace of the covariance, computed by every fit), so
+  they never fit more than twice the components needed.
+  '''
+  if method not in PCA_METHODS:
+    raise ValueError("unknown PCA method {}, expected one of {}".format(method, sorted(PCA_METHODS)))
+  if not 0 < n_components < 1:
+    return PCA_METHODS[method](X, int(n_components), **kwargs)
+
+  d = X.shape[1]
+  k = d if method == "exact" else min(d, PCA_RATIO_START)
+  while True:
+    basis = PCA_METHODS[method](X, k, **kwargs)
+    if k == d or basis.explained_variance_ratio.sum() >= n_components * (1 - 1e-12):
+      break
+    k = min(d, 2 * k)
+  k = select_n_components(basis, n_components)
+  curve = np.cumsum(basis.explained_variance_ratio)
+  for i in range(basis.n_components):
+    print("{:3d} components: {:.4f} of the variance{}".format(i + 1, curve[i], " <-" if i + 1 == k else ""))
+  print("Keeping", k, "components for", n_components, "of the variance")
+  return basis.truncate(k)
 
 
 def read_data():
   '''
   Read the train, dev, and test datasets
   '''
-  df_train = pd.read_csv('22m0754/regression/data/train.csv')
-  df_dev = pd.read_csv('22m0754/regression/data/dev.csv')
-  test_input = pd.read_csv('22m0754/regression/data/test.csv')  # .to_numpy()
+  train_input, train_target = load_csv('22m0754/regression/data/train.csv')
+  dev_input, dev_target = load_csv('22m0754/regression/data/dev.csv')
+  test_input, _ = load_csv('22m0754/regression/data/test.csv', False)
 
-  train_input = normalize(df_train.iloc[:, 1:], True).to_numpy()
+  train_input = normalize(train_input, True)
   # train_input = pca.fit_transform(train_input)
 
-  test_input = normalize(test_input, False).to_numpy()
+  test_input = normalize(test_input, False)
 
-  train_target = (df_train.iloc[:, 0]).to_numpy()
   train_target = train_target.reshape(train_target.shape[0], 1)
   # train_target = min_max_scaling(train_target)
-  dev_input = normalize(df_dev.iloc[:, 1:], False).to_numpy()
+  dev_input = normalize(dev_input, False)
   # dev_input = pca.transform(dev_input)
-  dev_target = (df_dev.iloc[:, 0]).to_numpy()
   dev_target = dev_target.reshape(dev_target.shape[0], 1)
   # dev_target = min_max_scaling(dev_target)
 
   if is_pca == "Y":
-    train_input, U = scratch_pca(train_input, n_components, "train", [])
-    dev_input, _  = scratch_pca(dev_input, n_components, "dev", U)
-    test_input, _  = scratch_pca(test_input, n_components, "test", U)
+    basis = fit_pca(train_input, n_components, pca_method)
+    train_input = basis.transform(train_input)
+    dev_input = basis.transform(dev_input)
+    test_input = basis.transform(test_input)
 
 
   return train_input, train_target, dev_input, dev_target, test_input
@@ -656,16 +960,11 @@ def read_data_non_normalize():
   '''
   Read the train, dev, and test datasets
   '''
-  df_train = pd.read_csv('22m0754/regression/data/train.csv')
-  df_dev = pd.read_csv('22m0754/regression/data/dev.csv')
-  test_input = pd.read_csv('22m0754/regression/data/test.csv')  # .to_numpy()
-  test_input = (test_input).to_numpy()
+  train_input, train_target = load_csv('22m0754/regression/data/train.csv')
+  dev_input, dev_target = load_csv('22m0754/regression/data/dev.csv')
+  test_input, _ = load_csv('22m0754/regression/data/test.csv', False)
 
-  train_input = (df_train.iloc[:, 1:]).to_numpy()
-  train_target = df_train.iloc[:, 0].to_numpy()
   train_target = train_target.reshape(train_target.shape[0], 1)
-  dev_input = (df_dev.iloc[:, 1:]).to_numpy()
-  dev_target = df_dev.iloc[:, 0].to_numpy()
   dev_target = dev_target.reshape(dev_target.shape[0], 1)
   return train_input, train_target, dev_input, dev_target, test_input
 
@@ -683,9 +982,11 @@ def main():
   lamda = 0.000 # Regularization Parameter
 
   train_input, train_target, dev_input, dev_target, test_input = read_data()
-  net = Net(num_layers, num_units)
+  # The first layer takes as many features as PCA kept
+  num_feats = train_input.shape[1]
+  net = Net(num_layers, num_units, num_feats)
   optimizer = Optimizer(learning_rate,"ADAM")
-  optimizer.SGD_ADAM(0.9,0.999, num_layers, num_units)
+  optimizer.SGD_ADAM(0.9,0.999, num_layers, num_units, num_feats)
   train(
     net, optimizer, lamda, batch_size, max_epochs,
     train_input, train_target,